@@ -14,6 +14,62 @@ import functools
 import logging
 
 
+class RequestArguments(object):
+    """A read-only view of the GET arguments of a `webob` request, mapping
+    each name to a list of values as `tornado.auth` expects.
+
+    Looking up a single name reads through to `request.GET`; the full dict
+    is only built the first time the arguments are iterated.
+    """
+    __slots__ = ('_get', '_dict')
+
+    def __init__(self, get):
+        self._get = get
+        self._dict = None
+
+    def _materialize(self):
+        if self._dict is None:
+            arguments = {}
+            for k, v in self._get.items():
+                arguments.setdefault(k, []).append(v)
+            self._dict = arguments
+        return self._dict
+
+    def __getitem__(self, name):
+        if self._dict is not None:
+            return self._dict[name]
+        values = self._get.getall(name)
+        if not values:
+            raise KeyError(name)
+        return values
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in self._get
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self._materialize())
+
+    def __len__(self):
+        return len(self._materialize())
+
+    def keys(self):
+        return self._materialize().keys()
+
+    def items(self):
+        return self._materialize().items()
+
+    def iteritems(self):
+        return self._materialize().iteritems()
+
+
 class RequestAdapter(object):
     """Adapter to transform a `webob` request into a request with the
     attributes expected by `tornado.auth`.
@@ -25,20 +81,36 @@ class RequestAdapter(object):
         request.host: current request host.
         request.path: current request path.
         request.full_url(): a function returning the current full URL.
+
+    Everything is read from the wrapped request on demand.
     """
+    __slots__ = ('_request', '_arguments')
+
     def __init__(self, request):
         """Initializes the request adapter.
 
         :param request:
             A `webob.Request` instance.
         """
-        self.arguments = {}
-        for k, v in request.GET.items():
-            self.arguments.setdefault(k, []).append(v)
+        self._request = request
+        self._arguments = None
+
+    @property
+    def arguments(self):
+        if self._arguments is None:
+            self._arguments = RequestArguments(self._request.GET)
+        return self._arguments
+
+    def full_url(self):
+        return self._request.url
+
+    @property
+    def host(self):
+        return self._request.host
 
-        self.full_url = lambda: request.url
-        self.host = request.host
-        self.path = request.path
+    @property
+    def path(self):
+        return self._request.path
 
 
 class RequestRedirect(Exception):
@@ -8,6 +8,11 @@ Original gaema is hosted at http://code.google.com/p/gaema/
 import functools
 import logging
 import base64
+import datetime
+import email.utils
+import re
+import threading
+import time
 
 from werkzeug.routing import RequestRedirect
 from werkzeug.exceptions import (
@@ -15,6 +20,8 @@ from werkzeug.exceptions import (
 )
 
 from kay.ext.gaema import auth
+from kay.ext.gaema import httpclient
+from kay.ext.gaema import stores
 from kay.utils import set_cookie
 from kay.conf import settings
 
@@ -23,6 +30,69 @@ mount_point = "/_ah/gaema"
 GAEMA_USER_KEY_FORMAT = "_%s_user"
 NEXT_URL_KEY_FORMAT = "_nexturl_%s"
 
+class RequestArguments(object):
+  """A read-only view of request arguments, mapping each name to a list of
+  values as `tornado.auth` expects.
+
+  Looking up a single name reads through to the underlying multidicts;
+  the full dict is only built the first time the arguments are iterated.
+  Like before, each multidict contributes the first value of a name.
+  """
+  __slots__ = ('_sources', '_dict')
+
+  def __init__(self, *sources):
+    self._sources = sources
+    self._dict = None
+
+  def _materialize(self):
+    if self._dict is None:
+      arguments = {}
+      for source in self._sources:
+        for k, v in source.items():
+          arguments.setdefault(k, []).append(v)
+      self._dict = arguments
+    return self._dict
+
+  def __getitem__(self, name):
+    if self._dict is not None:
+      return self._dict[name]
+    values = [source[name] for source in self._sources if name in source]
+    if not values:
+      raise KeyError(name)
+    return values
+
+  def get(self, name, default=None):
+    try:
+      return self[name]
+    except KeyError:
+      return default
+
+  def __contains__(self, name):
+    if self._dict is not None:
+      return name in self._dict
+    for source in self._sources:
+      if name in source:
+        return True
+    return False
+
+  has_key = __contains__
+
+  def __iter__(self):
+    return iter(self._materialize())
+
+  def __len__(self):
+    return len(self._materialize())
+
+  def keys(self):
+    return self._materialize().keys()
+
+  def items(self):
+    return self._materialize().items()
+
+  def iteritems(self):
+    return self._materialize().iteritems()
+
+
 class RequestAdapter(object):
   """Adapter to transform a `webob` request into a request with the
   attributes expected by `tornado.auth`.
@@ -34,23 +104,42 @@ class RequestAdapter(object):
   request.host: current request host.
   request.path: current request path.
   request.full_url(): a function returning the current full URL.
+
+  Everything is read from the wrapped request on demand, so requests that
+  only issue a redirect don't pay for copying their arguments.
   """
+  __slots__ = ('_request', '_arguments')
+
   def __init__(self, request):
     """Initializes the request adapter.
 
     :param request:
     A `werkzeug.Request` instance.
     """
-    self.arguments = {}
-    for k, v in request.args.items():
-      self.arguments.setdefault(k, []).append(v)
-    for k, v in request.form.items():
-      self.arguments.setdefault(k, []).append(v)
+    self._request = request
+    self._arguments = None
+
+  @property
+  def arguments(self):
+    if self._arguments is None:
+      self._arguments = RequestArguments(self._request.args,
+                                         self._request.form)
+    return self._arguments
+
+  def full_url(self):
+    return self._request.url
+
+  @property
+  def url_root(self):
+    return self._request.url_root
 
-    self.full_url = lambda: request.url
-    self.url_root = request.url_root
-    self.host = request.host
-    self.path = request.path
+  @property
+  def host(self):
+    return self._request.host
+
+  @property
+  def path(self):
+    return self._request.path
 
 
 class GAEMultiAuthMixin(object):
@@ -149,18 +238,98 @@ class YahooAuth(GAEMultiAuthMixin, auth.YahooMixin):
   arg_in_callback = 'openid.mode'
 
 
+MARKETPLACE_XRDS_URL = "https://www.google.com/accounts/o8/site-xrds?hd=%s"
+MARKETPLACE_FALLBACK_ENDPOINT = "https://www.google.com/a/%s/o8/ud?be=o8"
+# Used when the XRDS response carries no cache headers.
+MARKETPLACE_ENDPOINT_TTL = 3600
+# How long the fallback endpoint is used before retrying discovery.
+MARKETPLACE_FALLBACK_TTL = 300
+MARKETPLACE_DISCOVERY_TIMEOUT = 10
+
+_marketplace_endpoints = stores.MemoryStore(max_size=10000)
+_marketplace_discoveries = {}
+_marketplace_discoveries_lock = threading.Lock()
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+def _cache_ttl(headers, default):
+  """Returns the number of seconds a response may be cached according to
+  its Cache-Control or Expires headers."""
+  cache_control = headers.get("Cache-Control", "")
+  if "no-cache" in cache_control or "no-store" in cache_control:
+    return 0
+  match = _MAX_AGE_RE.search(cache_control)
+  if match:
+    return int(match.group(1))
+  expires = headers.get("Expires")
+  if expires:
+    expires = email.utils.parsedate_tz(expires)
+    if expires:
+      return max(0, int(email.utils.mktime_tz(expires) - time.time()))
+  return default
+
+def _discover_marketplace_endpoint(domain):
+  """Returns an `(endpoint, ttl)` pair for the given Google Apps domain."""
+  xrds_url = MARKETPLACE_XRDS_URL % domain
+  try:
+    from openid.consumer import discover
+    response = httpclient.AsyncHTTPClient().fetch(xrds_url).get_result()
+    if response.error:
+      raise Exception(response.error)
+    services = discover.getOPOrUserServices(
+      discover.OpenIDServiceEndpoint.fromXRDS(xrds_url, response.body))
+    return (services[0].server_url,
+            _cache_ttl(response.headers, MARKETPLACE_ENDPOINT_TTL))
+  except Exception, e:
+    logging.warning("XRDS discovery failed for %s: %s", domain, e)
+    return MARKETPLACE_FALLBACK_ENDPOINT % domain, MARKETPLACE_FALLBACK_TTL
+
+def get_marketplace_endpoint(domain):
+  """Returns the OpenID endpoint of the given Google Apps domain.
+
+  Endpoints are cached per domain as long as the XRDS cache headers allow,
+  and failed discoveries fall back to the default endpoint for a while.
+  Concurrent requests for the same domain wait for a single discovery.
+  """
+  endpoint = _marketplace_endpoints.get(domain)
+  if endpoint is not None:
+    return endpoint
+  _marketplace_discoveries_lock.acquire()
+  try:
+    event = _marketplace_discoveries.get(domain)
+    if event is None:
+      event = _marketplace_discoveries[domain] = threading.Event()
+      leader = True
+    else:
+      leader = False
+  finally:
+    _marketplace_discoveries_lock.release()
+  if not leader:
+    event.wait(MARKETPLACE_DISCOVERY_TIMEOUT)
+    endpoint = _marketplace_endpoints.get(domain)
+    if endpoint is None:
+      endpoint = MARKETPLACE_FALLBACK_ENDPOINT % domain
+    return endpoint
+  try:
+    endpoint, ttl = _discover_marketplace_endpoint(domain)
+    if ttl:
+      _marketplace_endpoints.set(domain, endpoint, ttl)
+  finally:
+    _marketplace_discoveries_lock.acquire()
+    try:
+      del _marketplace_discoveries[domain]
+    finally:
+      _marketplace_discoveries_lock.release()
+    event.set()
+  return endpoint
+
+
 class GoogleMarketPlaceAuth(GoogleAuth):
 
   def __init__(self, request, domain):
     GAEMultiAuthMixin.__init__(self, request)
     self.domain = domain
-    xrds_url = "https://www.google.com/accounts/o8/site-xrds?hd=%s" % domain
-    try:
-      from openid.consumer import discover
-      d = discover.discover(xrds_url)
-      self.set_endpoint(d[1][0].server_url)
-    except Exception:
-      self.set_endpoint("https://www.google.com/a/%s/o8/ud?be=o8" % domain)
+    self.set_endpoint(get_marketplace_endpoint(domain))
     
   def set_endpoint(self, endpoint):
     self._OPENID_ENDPOINT = endpoint
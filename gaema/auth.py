@@ -32,25 +32,53 @@ See the individual service classes below for complete documentation.
 
 import base64
 import binascii
+import calendar
 import cgi
+import functools
 import hashlib
 import hmac
+import itertools
 import logging
+import os
+import threading
 import time
 import urllib
 import urlparse
-import uuid
 
 from gaema import httpclient
 from gaema import escape
+from gaema import stores
+from gaema import ratelimit
 from gaema.httputil import url_concat
 from gaema.util import bytes_type, b
 
+_openid_query_cache = stores.MemoryStore(max_size=1000)
+
 class OpenIdMixin(object):
     """Abstract implementation of OpenID and Attribute Exchange.
 
     See GoogleMixin below for example implementations.
+
+    By default every login callback is verified with a stateless
+    check_authentication request to the OP. Set _OPENID_ASSOCIATION_STORE
+    to one of the stores in gaema.stores to use OpenID 2.0 associations
+    instead: a shared secret is established with the OP once per
+    association lifetime, and the callbacks are verified locally. The
+    stateless check is still used whenever the response can't be verified
+    with a known association.
     """
+    _OPENID_ASSOCIATION_STORE = None
+    # Attributes that can be requested with ax_attrs, besides "name".
+    # Extra attributes added by subclasses are copied to the user dict
+    # under their alias.
+    _OPENID_AX_TYPES = {
+        "email": "http://axschema.org/contact/email",
+        "language": "http://axschema.org/pref/language",
+        "username": "http://axschema.org/namePerson/friendly",
+    }
+    _OPENID_ASSOC_TYPES = ("HMAC-SHA256", "HMAC-SHA1")
+    _OPENID_NONCE_MAX_AGE = 300
+
     def authenticate_redirect(self, callback_uri=None,
                               ax_attrs=["name","email","language","username"]):
         """Returns the authentication URL for this service.
@@ -64,8 +92,8 @@ class OpenIdMixin(object):
         the ax_attrs keyword argument.
         """
         callback_uri = callback_uri or self.request.uri
-        args = self._openid_args(callback_uri, ax_attrs=ax_attrs)
-        self.redirect(self._OPENID_ENDPOINT + "?" + urllib.urlencode(args))
+        query = self._openid_query(callback_uri, ax_attrs=ax_attrs)
+        self.redirect(self._OPENID_ENDPOINT + "?" + query)
 
     def get_authenticated_user(self, callback):
         """Fetches the authenticated user data upon redirect.
@@ -74,25 +102,56 @@ class OpenIdMixin(object):
         redirect from the authenticate_redirect() or authorize_redirect()
         methods.
         """
-        # Verify the OpenID response via direct request to the OP
-        args = dict((k, v[-1]) for k, v in self.request.arguments.iteritems())
+        # Verify the OpenID response locally if we share an association
+        # with the OP, and via direct request to the OP otherwise. The
+        # check_authentication request doesn't change any state on the OP,
+        # so it is safe to retry.
+        args = self._openid_response_args()
+        if self._openid_response_association(args) is not None:
+            self._on_authentication_verified(callback, None)
+            return
+        args = dict(args)
         args["openid.mode"] = u"check_authentication"
         url = self._OPENID_ENDPOINT
         http = httpclient.AsyncHTTPClient()
         http.fetch(url, self.async_callback(
             self._on_authentication_verified, callback),
-            method="POST", body=urllib.urlencode(args))
+            method="POST", body=urllib.urlencode(args), idempotent=True)
+
+    def _openid_query(self, callback_uri, ax_attrs=[], oauth_scope=None):
+        """Returns the urlencoded checkid_setup arguments.
 
-    def _openid_args(self, callback_uri, ax_attrs=[], oauth_scope=None):
+        Only return_to and the association handle change between requests;
+        the rest is encoded once and cached per endpoint, attributes, scope
+        and realm.
+        """
         url = urlparse.urljoin(self.request.full_url(), callback_uri)
+        realm = urlparse.urljoin(url, '/')
+        consumer = oauth_scope and self.request.host.split(":")[0] or None
+        key = (self.__class__, self._OPENID_ENDPOINT, frozenset(ax_attrs),
+               oauth_scope, realm, consumer)
+        query = _openid_query_cache.get(key)
+        if query is None:
+            query = urllib.urlencode(self._openid_static_args(
+                realm, ax_attrs, oauth_scope, consumer))
+            _openid_query_cache.set(key, query)
+        query += "&openid.return_to=" + urllib.quote_plus(url)
+        association = self._openid_association()
+        if association:
+            query += "&openid.assoc_handle=" + \
+                urllib.quote_plus(association["handle"])
+        return query
+
+    def _openid_static_args(self, realm, ax_attrs, oauth_scope, consumer):
+        """Returns the checkid_setup arguments that don't depend on the
+        request's return_to URL."""
         args = {
             "openid.ns": "http://specs.openid.net/auth/2.0",
             "openid.claimed_id":
                 "http://specs.openid.net/auth/2.0/identifier_select",
             "openid.identity":
                 "http://specs.openid.net/auth/2.0/identifier_select",
-            "openid.return_to": url,
-            "openid.realm": urlparse.urljoin(url, '/'),
+            "openid.realm": realm,
             "openid.mode": "checkid_setup",
         }
         if ax_attrs:
@@ -113,49 +172,157 @@ class OpenIdMixin(object):
                     "openid.ax.type.lastname":
                         "http://axschema.org/namePerson/last",
                 })
-            known_attrs = {
-                "email": "http://axschema.org/contact/email",
-                "language": "http://axschema.org/pref/language",
-                "username": "http://axschema.org/namePerson/friendly",
-            }
             for name in ax_attrs:
-                args["openid.ax.type." + name] = known_attrs[name]
+                args["openid.ax.type." + name] = self._OPENID_AX_TYPES[name]
                 required.append(name)
             args["openid.ax.required"] = ",".join(required)
         if oauth_scope:
             args.update({
                 "openid.ns.oauth":
                     "http://specs.openid.net/extensions/oauth/1.0",
-                "openid.oauth.consumer": self.request.host.split(":")[0],
+                "openid.oauth.consumer": consumer,
                 "openid.oauth.scope": oauth_scope,
             })
         return args
 
+    def _openid_association(self):
+        """Returns the association to use with the OP, establishing a new
+        one if needed, or None to use stateless mode."""
+        store = self._OPENID_ASSOCIATION_STORE
+        # Without Diffie-Hellman the MAC key is sent in the clear, which
+        # the spec only allows over HTTPS.
+        if store is None or not self._OPENID_ENDPOINT.startswith("https://"):
+            return None
+        key = "openid_assoc:" + self._OPENID_ENDPOINT
+        association = store.get(key)
+        if association is None:
+            association = self._openid_associate()
+            if association:
+                ttl = association["expires"] - int(time.time())
+                store.set(key, association, ttl)
+                store.set(key + ":" + association["handle"], association, ttl)
+            else:
+                # Don't ask an OP refusing associations on every redirect.
+                store.set(key, {}, 3600)
+        return association or None
+
+    def _openid_associate(self):
+        """Establishes a new association with the OP."""
+        association = []
+        http = httpclient.AsyncHTTPClient()
+        assoc_types = list(self._OPENID_ASSOC_TYPES)
+        while assoc_types:
+            assoc_type = assoc_types.pop(0)
+            args = {
+                "openid.ns": "http://specs.openid.net/auth/2.0",
+                "openid.mode": "associate",
+                "openid.assoc_type": assoc_type,
+                "openid.session_type": "no-encryption",
+            }
+            response = http.fetch(self._OPENID_ENDPOINT, method="POST",
+                                  body=urllib.urlencode(args)).get_result()
+            if response.code not in (200, 400):
+                logging.warning("OpenID association failed: %s",
+                                response.error)
+                return None
+            values = _openid_parse_kv(response.body)
+            if values.get("error_code") == "unsupported-type":
+                suggested = values.get("assoc_type")
+                if suggested in assoc_types:
+                    assoc_types = [suggested]
+                continue
+            if response.error or "mac_key" not in values:
+                logging.warning("OpenID association failed: %s",
+                                values.get("error", response.error))
+                return None
+            return {
+                "handle": values["assoc_handle"],
+                "type": values.get("assoc_type", assoc_type),
+                "secret": base64.b64decode(values["mac_key"]),
+                "expires": int(time.time()) + int(values["expires_in"]),
+            }
+        logging.warning("OpenID association failed: no supported type")
+        return None
+
+    def _openid_response_association(self, args):
+        """Returns the association the given response is signed with, or
+        None if it has to be verified with the OP."""
+        store = self._OPENID_ASSOCIATION_STORE
+        handle = args.get("openid.assoc_handle")
+        if store is None or not handle or "openid.invalidate_handle" in args:
+            return None
+        if args.get("openid.op_endpoint") != self._OPENID_ENDPOINT:
+            return None
+        return store.get("openid_assoc:%s:%s" % (self._OPENID_ENDPOINT,
+                                                 handle))
+
+    def _openid_check_signature(self):
+        """Verifies the signature of the OpenID response with the shared
+        association secret, and that its nonce hasn't been seen before."""
+        args = self._openid_response_args()
+        association = self._openid_response_association(args)
+        if association is None:
+            return False
+        signed = args.get("openid.signed", "").split(",")
+        required = ["op_endpoint", "return_to", "response_nonce",
+                    "assoc_handle"]
+        if "openid.claimed_id" in args:
+            required += ["claimed_id", "identity"]
+        for field in required:
+            if field not in signed:
+                logging.warning("OpenID field %s is not signed", field)
+                return False
+        message = "".join("%s:%s\n" % (field, args.get("openid." + field, u""))
+                          for field in signed)
+        if association["type"] == "HMAC-SHA256":
+            digestmod = hashlib.sha256
+        else:
+            digestmod = hashlib.sha1
+        signature = base64.b64encode(hmac.new(
+            association["secret"], message.encode("utf-8"),
+            digestmod).digest())
+        if not escape.time_independent_equals(signature,
+                                              args.get("openid.sig", "")):
+            logging.warning("Invalid OpenID signature")
+            return False
+        return_to = urlparse.urlparse(args["openid.return_to"])
+        if return_to[2] != self.request.path:
+            logging.warning("OpenID return_to does not match this request")
+            return False
+        nonce = args["openid.response_nonce"]
+        try:
+            issued = calendar.timegm(time.strptime(nonce[:20],
+                                                   "%Y-%m-%dT%H:%M:%SZ"))
+        except ValueError:
+            logging.warning("Malformed OpenID nonce %r", nonce)
+            return False
+        if abs(time.time() - issued) > self._OPENID_NONCE_MAX_AGE:
+            logging.warning("Expired OpenID nonce %r", nonce)
+            return False
+        store = self._OPENID_ASSOCIATION_STORE
+        if not store.add("openid_nonce:%s:%s" % (self._OPENID_ENDPOINT,
+                                                 nonce), True,
+                         2 * self._OPENID_NONCE_MAX_AGE):
+            logging.warning("Replayed OpenID nonce %r", nonce)
+            return False
+        return True
+
     def _on_authentication_verified(self, callback, response):
-        if response.error or b("is_valid:true") not in response.body:
+        if response is None:
+            # Signed with an association we share with the OP.
+            if not self._openid_check_signature():
+                callback(None)
+                return
+        elif response.error or b("is_valid:true") not in response.body:
             logging.warning("Invalid OpenID response: %s", response.error or
                             response.body)
             callback(None)
             return
 
         # Make sure we got back at least an email from attribute exchange
-        ax_ns = None
-        for name in self.request.arguments.iterkeys():
-            if name.startswith("openid.ns.") and \
-               self.get_argument(name) == u"http://openid.net/srv/ax/1.0":
-                ax_ns = name[10:]
-                break
+        ax = self.get_ax_attributes()
         def get_ax_arg(uri):
-            if not ax_ns: return u""
-            prefix = "openid." + ax_ns + ".type."
-            ax_name = None
-            for name in self.request.arguments.iterkeys():
-                if self.get_argument(name) == uri and name.startswith(prefix):
-                    part = name[len(prefix):]
-                    ax_name = "openid." + ax_ns + ".value." + part
-                    break
-            if not ax_name: return u""
-            return self.get_argument(ax_name, u"")
+            return ax.get(uri, u"")
 
         email = get_ax_arg("http://axschema.org/contact/email")
         name = get_ax_arg("http://axschema.org/namePerson")
@@ -180,14 +347,124 @@ class OpenIdMixin(object):
         if email: user["email"] = email
         if locale: user["locale"] = locale
         if username: user["username"] = username
+        for alias, uri in self._OPENID_AX_TYPES.iteritems():
+            if alias not in _OPENID_STANDARD_AX_ATTRS and ax.get(uri):
+                user[alias] = ax[uri]
         callback(user)
 
+    def _openid_response_args(self):
+        """Returns the OpenID response arguments, with the last value of
+        each; they are only collected once per request."""
+        if getattr(self, "_openid_response", None) is None:
+            self._openid_response = dict(
+                (k, v[-1]) for k, v in self.request.arguments.iteritems())
+        return self._openid_response
+
+    def get_ax_attributes(self):
+        """Returns a dict mapping the AX type URIs of the OpenID response to
+        their values.
+
+        The request arguments are scanned once per request; the namespace
+        alias the OP chose for AX is resolved while doing so. Only the
+        fields listed in openid.signed are used, since anyone can append
+        unsigned ones to the response.
+        """
+        if getattr(self, "_ax_attributes", None) is None:
+            signed = self._openid_response_args().get("openid.signed", u"")
+            self._ax_attributes = _openid_parse_ax(self.request.arguments,
+                                                   signed.split(","))
+        return self._ax_attributes
+
+
+class OAuthNonceSource(object):
+    """Generates OAuth nonces and timestamps.
+
+    Instead of reading os.urandom for every nonce, entropy is read in
+    blocks of buffer_size bytes and sliced. The timestamp string is only
+    rebuilt when the second changes.
+    """
+    nonce_size = 16
+
+    def __init__(self, buffer_size=4096):
+        self.buffer_size = buffer_size
+        self._buffer = ""
+        self._offset = 0
+        self._timestamp = (None, None)
+        self._lock = threading.Lock()
+
+    def timestamp(self):
+        now = int(time.time())
+        second, timestamp = self._timestamp
+        if second != now:
+            timestamp = str(now)
+            self._timestamp = (now, timestamp)
+        return timestamp
+
+    def nonce(self):
+        self._lock.acquire()
+        try:
+            offset = self._offset
+            if offset + self.nonce_size > len(self._buffer):
+                self._buffer = os.urandom(self.buffer_size)
+                offset = 0
+            self._offset = offset + self.nonce_size
+            return binascii.b2a_hex(
+                self._buffer[offset:offset + self.nonce_size])
+        finally:
+            self._lock.release()
+
+class UniqueOAuthNonceSource(OAuthNonceSource):
+    """An OAuthNonceSource that never returns the same nonce twice within
+    window seconds, checked against a store from gaema.stores.
+
+    Use a MemcacheStore or DatastoreStore to guarantee uniqueness across
+    processes.
+    """
+    def __init__(self, store=None, window=900, buffer_size=4096):
+        OAuthNonceSource.__init__(self, buffer_size)
+        if store is None:
+            store = stores.MemoryStore(max_size=100000)
+        self.store = store
+        self.window = window
+
+    def nonce(self):
+        while True:
+            nonce = OAuthNonceSource.nonce(self)
+            if self.store.add("oauth_nonce:" + nonce, True, self.window):
+                return nonce
+            logging.warning("Discarding reused OAuth nonce %s", nonce)
 
 class OAuthMixin(object):
     """Abstract implementation of OAuth.
 
     See TwitterMixin and FriendFeedMixin below for example implementations.
+
+    Requests are signed with _OAUTH_SIGNATURE_METHOD, one of the methods
+    registered with register_oauth_signature_method(): "HMAC-SHA1" (the
+    default), "HMAC-SHA256" or "RSA-SHA1". RSA-SHA1 signs with the PEM
+    private key found under "private_key" in _oauth_consumer_token().
+
+    Nonces and timestamps come from _OAUTH_NONCE_SOURCE, which can be
+    replaced with e.g. a UniqueOAuthNonceSource for providers that reject
+    reused nonces.
+
+    GET requests to the provider API can be cached by setting
+    _RESPONSE_CACHE to a gaema.httpclient.ResponseCache.
+
+    Provider API calls are paced by _RATE_LIMITER, if set to a
+    gaema.ratelimit.RateLimitScheduler. Handlers doing background work
+    should set _RATE_LIMIT_PRIORITY to ratelimit.BATCH so they leave
+    quota for interactive requests. Calls refused by the rate limiter or
+    by the provider's own limits pass None to the callback like other
+    failures, unless an on_rate_limited callback is given to the request
+    method: it is then called with the number of seconds to wait before
+    trying again.
     """
+    _OAUTH_SIGNATURE_METHOD = "HMAC-SHA1"
+    _RESPONSE_CACHE = None
+    _RATE_LIMITER = None
+    _RATE_LIMIT_PRIORITY = ratelimit.INTERACTIVE
+    _OAUTH_NONCE_SOURCE = OAuthNonceSource()
 
     def authorize_redirect(self, callback_uri=None, extra_params=None):
         """Redirects the user to obtain OAuth authorization for this service.
@@ -253,9 +530,9 @@ class OAuthMixin(object):
         url = self._OAUTH_REQUEST_TOKEN_URL
         args = dict(
             oauth_consumer_key=consumer_token["key"],
-            oauth_signature_method="HMAC-SHA1",
-            oauth_timestamp=str(int(time.time())),
-            oauth_nonce=binascii.b2a_hex(uuid.uuid4().bytes),
+            oauth_signature_method=self._OAUTH_SIGNATURE_METHOD,
+            oauth_timestamp=self._OAUTH_NONCE_SOURCE.timestamp(),
+            oauth_nonce=self._OAUTH_NONCE_SOURCE.nonce(),
             oauth_version=getattr(self, "_OAUTH_VERSION", "1.0a"),
         )
         if getattr(self, "_OAUTH_VERSION", "1.0a") == "1.0a":
@@ -263,11 +540,8 @@ class OAuthMixin(object):
                 args["oauth_callback"] = urlparse.urljoin(
                     self.request.full_url(), callback_uri)
             if extra_params: args.update(extra_params)
-            signature = _oauth10a_signature(consumer_token, "GET", url, args)
-        else:
-            signature = _oauth_signature(consumer_token, "GET", url, args)
 
-        args["oauth_signature"] = signature
+        args["oauth_signature"] = self._oauth_signer().sign("GET", url, args)
         return url + "?" + urllib.urlencode(args)
 
     def _on_request_token(self, authorize_url, callback_uri, response):
@@ -289,22 +563,16 @@ class OAuthMixin(object):
         args = dict(
             oauth_consumer_key=consumer_token["key"],
             oauth_token=request_token["key"],
-            oauth_signature_method="HMAC-SHA1",
-            oauth_timestamp=str(int(time.time())),
-            oauth_nonce=binascii.b2a_hex(uuid.uuid4().bytes),
+            oauth_signature_method=self._OAUTH_SIGNATURE_METHOD,
+            oauth_timestamp=self._OAUTH_NONCE_SOURCE.timestamp(),
+            oauth_nonce=self._OAUTH_NONCE_SOURCE.nonce(),
             oauth_version=getattr(self, "_OAUTH_VERSION", "1.0a"),
         )
         if "verifier" in request_token:
           args["oauth_verifier"]=request_token["verifier"]
 
-        if getattr(self, "_OAUTH_VERSION", "1.0a") == "1.0a":
-            signature = _oauth10a_signature(consumer_token, "GET", url, args,
-                                            request_token)
-        else:
-            signature = _oauth_signature(consumer_token, "GET", url, args,
-                                         request_token)
-
-        args["oauth_signature"] = signature
+        args["oauth_signature"] = self._oauth_signer(request_token).sign(
+            "GET", url, args)
         return url + "?" + urllib.urlencode(args)
 
     def _on_access_token(self, callback, response):
@@ -338,25 +606,39 @@ class OAuthMixin(object):
         base_args = dict(
             oauth_consumer_key=consumer_token["key"],
             oauth_token=access_token["key"],
-            oauth_signature_method="HMAC-SHA1",
-            oauth_timestamp=str(int(time.time())),
-            oauth_nonce=binascii.b2a_hex(uuid.uuid4().bytes),
+            oauth_signature_method=self._OAUTH_SIGNATURE_METHOD,
+            oauth_timestamp=self._OAUTH_NONCE_SOURCE.timestamp(),
+            oauth_nonce=self._OAUTH_NONCE_SOURCE.nonce(),
             oauth_version=getattr(self, "_OAUTH_VERSION", "1.0a"),
         )
         args = {}
         args.update(base_args)
         args.update(parameters)
-        if getattr(self, "_OAUTH_VERSION", "1.0a") == "1.0a":
-            signature = _oauth10a_signature(consumer_token, method, url, args,
-                                         access_token)
-        else:
-            signature = _oauth_signature(consumer_token, method, url, args,
-                                         access_token)
-        base_args["oauth_signature"] = signature
+        base_args["oauth_signature"] = self._oauth_signer(access_token).sign(
+            method, url, args)
         return base_args
 
+    def _oauth_signer(self, token=None):
+        """Returns the OAuthSigner for the consumer token and given token."""
+        return get_oauth_signer(self._oauth_consumer_token(), token,
+                                getattr(self, "_OAUTH_VERSION", "1.0a"),
+                                self._OAUTH_SIGNATURE_METHOD)
+
 class OAuth2Mixin(object):
-    """Abstract implementation of OAuth v 2."""
+    """Abstract implementation of OAuth v 2.
+
+    Set _ACCESS_TOKEN_STORE to a gaema.stores.AccessTokenStore to keep the
+    access tokens of authenticated users, keyed by _OAUTH_SERVICE_NAME and
+    user id, so later requests on their behalf don't need the session.
+    GET requests to the provider API can be cached by setting
+    _RESPONSE_CACHE to a gaema.httpclient.ResponseCache, and paced with
+    _RATE_LIMITER as described in OAuthMixin.
+    """
+    _ACCESS_TOKEN_STORE = None
+    _RESPONSE_CACHE = None
+    _RATE_LIMITER = None
+    _RATE_LIMIT_PRIORITY = ratelimit.INTERACTIVE
+    _OAUTH_SERVICE_NAME = None
 
     def authorize_redirect(self, redirect_uri=None, client_id=None,
                            client_secret=None, extra_params=None ):
@@ -389,6 +671,22 @@ class OAuth2Mixin(object):
         if extra_params: args.update(extra_params)
         return url_concat(url, args)
 
+    def get_stored_access_token(self, user_id):
+        """Returns the stored access token entry for the given user, as
+        returned by AccessTokenStore.get(), or None."""
+        if self._ACCESS_TOKEN_STORE is None:
+            return None
+        return self._ACCESS_TOKEN_STORE.get(self._OAUTH_SERVICE_NAME, user_id)
+
+    def _store_access_token(self, user_id, access_token, expires_in=None):
+        if self._ACCESS_TOKEN_STORE is None or not user_id:
+            return
+        expires = None
+        if expires_in:
+            expires = time.time() + int(expires_in)
+        self._ACCESS_TOKEN_STORE.set(self._OAUTH_SERVICE_NAME, user_id,
+                                     access_token, expires)
+
 class TwitterMixin(OAuthMixin):
     """Twitter OAuth authentication.
 
@@ -441,7 +739,7 @@ class TwitterMixin(OAuthMixin):
             self._on_request_token, self._OAUTH_AUTHENTICATE_URL, None))
 
     def twitter_request(self, path, callback, access_token=None,
-                           post_args=None, **args):
+                           post_args=None, on_rate_limited=None, **args):
         """Fetches the given API path, e.g., "/statuses/user_timeline/btaylor"
 
         The path should not include the format (we automatically append
@@ -478,28 +776,61 @@ class TwitterMixin(OAuthMixin):
                     self.finish("Posted a message!")
 
         """
+        cache_key = None
+        if post_args is None and self._RESPONSE_CACHE is not None:
+            cache_key = self._RESPONSE_CACHE.key(
+                "twitter", path, args, access_token and access_token["key"])
+        url, fetch_args = self._twitter_request_args(path, access_token,
+                                                     post_args, args)
+        callback = self.async_callback(self._on_twitter_request, callback,
+                                       on_rate_limited=on_rate_limited)
+        http = _provider_http(self, "twitter",
+                              access_token and access_token["key"])
+        _provider_fetch(http, self._RESPONSE_CACHE, cache_key, path, url,
+                        fetch_args, callback)
+
+    def twitter_request_many(self, requests, callback, access_token=None):
+        """Fetches several API paths concurrently.
+
+        requests is a list of paths, or of (path, args) pairs where args is
+        a dict of query string arguments. All the requests are sent at once
+        and callback is called with the list of decoded responses, in the
+        same order, with None for the ones that failed::
+
+            self.twitter_request_many(
+                ["/users/show/" + name, ("/statuses/user_timeline",
+                                         {"screen_name": name})],
+                access_token=user["access_token"],
+                callback=self.async_callback(self._on_profile))
+        """
+        fetches = []
+        for path, args in _normalize_requests(requests):
+            url, fetch_args = self._twitter_request_args(path, access_token,
+                                                         None, args)
+            fetches.append((url, fetch_args, self._on_twitter_request))
+        _fetch_many(fetches, callback, _provider_http(
+            self, "twitter", access_token and access_token["key"]))
+
+    def _twitter_request_args(self, path, access_token, post_args, args):
         # Add the OAuth resource request signature if we have credentials
         url = "http://api.twitter.com/1" + path + ".json"
         if access_token:
             all_args = {}
             all_args.update(args)
             all_args.update(post_args or {})
-            consumer_token = self._oauth_consumer_token()
             method = "POST" if post_args is not None else "GET"
             oauth = self._oauth_request_parameters(
                 url, access_token, all_args, method=method)
             args.update(oauth)
         if args: url += "?" + urllib.urlencode(args)
-        callback = self.async_callback(self._on_twitter_request, callback)
-        http = httpclient.AsyncHTTPClient()
         if post_args is not None:
-            http.fetch(url, method="POST", body=urllib.urlencode(post_args),
-                       callback=callback)
-        else:
-            http.fetch(url, callback=callback)
+            return url, dict(method="POST", body=urllib.urlencode(post_args))
+        return url, {}
 
-    def _on_twitter_request(self, callback, response):
+    def _on_twitter_request(self, callback, response, on_rate_limited=None):
         if response.error:
+            if _report_rate_limited(response, on_rate_limited):
+                return
             logging.warning("Error response %s fetching %s", response.error,
                             response.request.url)
             callback(None)
@@ -567,7 +898,7 @@ class FriendFeedMixin(OAuthMixin):
 
 
     def friendfeed_request(self, path, callback, access_token=None,
-                           post_args=None, **args):
+                           post_args=None, on_rate_limited=None, **args):
         """Fetches the given relative API path, e.g., "/bret/friends"
 
         If the request is a POST, post_args should be provided. Query
@@ -601,28 +932,55 @@ class FriendFeedMixin(OAuthMixin):
                     self.finish("Posted a message!")
 
         """
+        cache_key = None
+        if post_args is None and self._RESPONSE_CACHE is not None:
+            cache_key = self._RESPONSE_CACHE.key(
+                "friendfeed", path, args,
+                access_token and access_token["key"])
+        url, fetch_args = self._friendfeed_request_args(path, access_token,
+                                                        post_args, args)
+        callback = self.async_callback(self._on_friendfeed_request, callback,
+                                       on_rate_limited=on_rate_limited)
+        http = _provider_http(self, "friendfeed",
+                              access_token and access_token["key"])
+        _provider_fetch(http, self._RESPONSE_CACHE, cache_key, path, url,
+                        fetch_args, callback)
+
+    def friendfeed_request_many(self, requests, callback, access_token=None):
+        """Fetches several API paths concurrently.
+
+        See TwitterMixin.twitter_request_many() for the format of requests
+        and the results passed to callback.
+        """
+        fetches = []
+        for path, args in _normalize_requests(requests):
+            url, fetch_args = self._friendfeed_request_args(
+                path, access_token, None, args)
+            fetches.append((url, fetch_args, self._on_friendfeed_request))
+        _fetch_many(fetches, callback, _provider_http(
+            self, "friendfeed", access_token and access_token["key"]))
+
+    def _friendfeed_request_args(self, path, access_token, post_args, args):
         # Add the OAuth resource request signature if we have credentials
         url = "http://friendfeed-api.com/v2" + path
         if access_token:
             all_args = {}
             all_args.update(args)
             all_args.update(post_args or {})
-            consumer_token = self._oauth_consumer_token()
             method = "POST" if post_args is not None else "GET"
             oauth = self._oauth_request_parameters(
                 url, access_token, all_args, method=method)
             args.update(oauth)
         if args: url += "?" + urllib.urlencode(args)
-        callback = self.async_callback(self._on_friendfeed_request, callback)
-        http = httpclient.AsyncHTTPClient()
         if post_args is not None:
-            http.fetch(url, method="POST", body=urllib.urlencode(post_args),
-                       callback=callback)
-        else:
-            http.fetch(url, callback=callback)
+            return url, dict(method="POST", body=urllib.urlencode(post_args))
+        return url, {}
 
-    def _on_friendfeed_request(self, callback, response):
+    def _on_friendfeed_request(self, callback, response,
+                               on_rate_limited=None):
         if response.error:
+            if _report_rate_limited(response, on_rate_limited):
+                return
             logging.warning("Error response %s fetching %s", response.error,
                             response.request.url)
             callback(None)
@@ -690,9 +1048,9 @@ class GoogleMixin(OpenIdMixin, OAuthMixin):
         URLs with a space.
         """
         callback_uri = callback_uri or self.request.uri
-        args = self._openid_args(callback_uri, ax_attrs=ax_attrs,
-                                 oauth_scope=oauth_scope)
-        self.redirect(self._OPENID_ENDPOINT + "?" + urllib.urlencode(args))
+        query = self._openid_query(callback_uri, ax_attrs=ax_attrs,
+                                   oauth_scope=oauth_scope)
+        self.redirect(self._OPENID_ENDPOINT + "?" + query)
 
     def get_authenticated_user(self, callback):
         """Fetches the authenticated user data upon redirect."""
@@ -714,6 +1072,14 @@ class GoogleMixin(OpenIdMixin, OAuthMixin):
 
     def _oauth_consumer_token(self):
         self.require_setting("google_consumer_key", "Google OAuth")
+        if self._OAUTH_SIGNATURE_METHOD == "RSA-SHA1":
+            # Registered with a certificate; no consumer secret is used.
+            self.require_setting("google_consumer_private_key",
+                                 "Google OAuth with RSA-SHA1")
+            return dict(
+                key=self.settings["google_consumer_key"],
+                secret=self.settings.get("google_consumer_secret", ""),
+                private_key=self.settings["google_consumer_private_key"])
         self.require_setting("google_consumer_secret", "Google OAuth")
         return dict(
             key=self.settings["google_consumer_key"],
@@ -755,7 +1121,17 @@ class FacebookMixin(object):
     like 'session_key'. You should save the session key with the user; it is
     required to make requests on behalf of the user later with
     facebook_request().
+
+    Responses of facebook_request() can be cached by setting
+    _RESPONSE_CACHE to a gaema.httpclient.ResponseCache. Only the methods
+    it has a TTL for are cached, so keep write methods out of it. Calls
+    are paced with _RATE_LIMITER as described in OAuthMixin.
     """
+    _FACEBOOK_API_URL = "http://api.facebook.com/restserver.php"
+    _RESPONSE_CACHE = None
+    _RATE_LIMITER = None
+    _RATE_LIMIT_PRIORITY = ratelimit.INTERACTIVE
+
     def authenticate_redirect(self, callback_uri=None, cancel_uri=None,
                               extended_permissions=None):
         """Authenticates/installs this app for the current user."""
@@ -818,7 +1194,8 @@ class FacebookMixin(object):
             fields="uid,first_name,last_name,name,locale,pic_square," \
                    "profile_url,username")
 
-    def facebook_request(self, method, callback, **args):
+    def facebook_request(self, method, callback, on_rate_limited=None,
+                         **args):
         """Makes a Facebook API REST request.
 
         We automatically include the Facebook API key and signature, but
@@ -852,17 +1229,22 @@ class FacebookMixin(object):
         self.require_setting("facebook_secret", "Facebook Connect")
         if not method.startswith("facebook."):
             method = "facebook." + method
+        cache_key = None
+        if self._RESPONSE_CACHE is not None:
+            cache_key = self._RESPONSE_CACHE.key(
+                "facebook", method, args, args.get("session_key"))
         args["api_key"] = self.settings["facebook_api_key"]
         args["v"] = "1.0"
         args["method"] = method
         args["call_id"] = str(long(time.time() * 1e6))
         args["format"] = "json"
         args["sig"] = self._signature(args)
-        url = "http://api.facebook.com/restserver.php?" + \
-            urllib.urlencode(args)
-        http = httpclient.AsyncHTTPClient()
-        http.fetch(url, callback=self.async_callback(
-            self._parse_response, callback))
+        url = self._FACEBOOK_API_URL + "?" + urllib.urlencode(args)
+        http = _provider_http(self, "facebook", args.get("session_key"))
+        _provider_fetch(http, self._RESPONSE_CACHE, cache_key, method, url,
+                        {}, self.async_callback(
+                            self._parse_response, callback,
+                            on_rate_limited=on_rate_limited))
 
     def _on_get_user_info(self, callback, session, users):
         if users is None:
@@ -881,8 +1263,10 @@ class FacebookMixin(object):
             "session_expires": session.get("expires"),
         })
 
-    def _parse_response(self, callback, response):
+    def _parse_response(self, callback, response, on_rate_limited=None):
         if response.error:
+            if _report_rate_limited(response, on_rate_limited):
+                return
             logging.warning("HTTP error from Facebook: %s", response.error)
             callback(None)
             return
@@ -910,6 +1294,7 @@ class FacebookGraphMixin(OAuth2Mixin):
     _OAUTH_ACCESS_TOKEN_URL = "https://graph.facebook.com/oauth/access_token?"
     _OAUTH_AUTHORIZE_URL = "https://graph.facebook.com/oauth/authorize?"
     _OAUTH_NO_CALLBACKS = False
+    _OAUTH_SERVICE_NAME = "facebook"
 
     def get_authenticated_user(self, redirect_uri, client_id, client_secret,
                               code, callback, extra_fields=None):
@@ -986,10 +1371,13 @@ class FacebookGraphMixin(OAuth2Mixin):
             fieldmap[field] = user.get(field)
 
         fieldmap.update({"access_token": session["access_token"], "session_expires": session.get("expires")})
+        expires = session.get("expires")
+        self._store_access_token(user.get("id"), session["access_token"],
+                                 expires and expires[-1])
         callback(fieldmap)
 
     def facebook_request(self, path, callback, access_token=None,
-                           post_args=None, **args):
+                           post_args=None, on_rate_limited=None, **args):
         """Fetches the given relative API path, e.g., "/btaylor/picture"
 
         If the request is a POST, post_args should be provided. Query
@@ -1023,6 +1411,60 @@ class FacebookGraphMixin(OAuth2Mixin):
                     self.finish("Posted a message!")
 
         """
+        cache_key = None
+        if post_args is None and self._RESPONSE_CACHE is not None:
+            cache_key = self._RESPONSE_CACHE.key("facebook_graph", path, args,
+                                                 access_token)
+        url, fetch_args = self._facebook_request_args(path, access_token,
+                                                      post_args, args)
+        callback = self.async_callback(self._on_facebook_request, callback,
+                                       on_rate_limited=on_rate_limited)
+        http = _provider_http(self, "facebook_graph", access_token)
+        _provider_fetch(http, self._RESPONSE_CACHE, cache_key, path, url,
+                        fetch_args, callback)
+
+    def facebook_user_request(self, user_id, path, callback, post_args=None,
+                              **args):
+        """Like facebook_request(), using the access token stored for the
+        given user id in _ACCESS_TOKEN_STORE.
+
+        callback is called with None if no valid token is stored. A warning
+        is logged for tokens about to expire, which should be renewed by
+        sending the user through authorize_redirect() again.
+        """
+        entry = self.get_stored_access_token(user_id)
+        if entry is None:
+            logging.warning("No Facebook access token stored for %s", user_id)
+            callback(None)
+            return
+        if entry["expiring"]:
+            logging.warning("Facebook access token for %s expires soon",
+                            user_id)
+        self.facebook_request(path, callback, entry["access_token"],
+                              post_args, **args)
+
+    def facebook_request_many(self, requests, callback, access_token=None):
+        """Fetches several Graph API paths concurrently.
+
+        requests is a list of paths, or of (path, args) pairs where args is
+        a dict of query string arguments. All the requests are sent at once
+        and callback is called with the list of decoded responses, in the
+        same order, with None for the ones that failed::
+
+            self.facebook_request_many(
+                ["/me", ("/me/friends", {"limit": "50"}), "/me/likes"],
+                access_token=self.current_user["access_token"],
+                callback=self.async_callback(self._on_profile))
+        """
+        fetches = []
+        for path, args in _normalize_requests(requests):
+            url, fetch_args = self._facebook_request_args(path, access_token,
+                                                          None, args)
+            fetches.append((url, fetch_args, self._on_facebook_request))
+        _fetch_many(fetches, callback,
+                    _provider_http(self, "facebook_graph", access_token))
+
+    def _facebook_request_args(self, path, access_token, post_args, args):
         url = "https://graph.facebook.com" + path
         all_args = {}
         if access_token:
@@ -1030,67 +1472,380 @@ class FacebookGraphMixin(OAuth2Mixin):
             all_args.update(args)
             all_args.update(post_args or {})
         if all_args: url += "?" + urllib.urlencode(all_args)
-        callback = self.async_callback(self._on_facebook_request, callback)
-        http = httpclient.AsyncHTTPClient()
         if post_args is not None:
-            http.fetch(url, method="POST", body=urllib.urlencode(post_args),
-                       callback=callback)
-        else:
-            http.fetch(url, callback=callback)
+            return url, dict(method="POST", body=urllib.urlencode(post_args))
+        return url, {}
 
-    def _on_facebook_request(self, callback, response):
+    def _on_facebook_request(self, callback, response, on_rate_limited=None):
         if response.error:
+            if _report_rate_limited(response, on_rate_limited):
+                return
             logging.warning("Error response %s fetching %s", response.error,
                             response.request.url)
             callback(None)
             return
         callback(escape.json_decode(response.body))
 
-def _oauth_signature(consumer_token, method, url, parameters={}, token=None):
-    """Calculates the HMAC-SHA1 OAuth signature for the given request.
+    _GRAPH_BATCH_SIZE = 50
 
-    See http://oauth.net/core/1.0/#signing_process
+    def facebook_batch_request(self, requests, callback=None,
+                               access_token=None):
+        """Fetches many Graph API paths using the Graph batch endpoint.
+
+        Instead of one HTTP round trip per path, up to 50 requests are
+        packed into each call to the batch endpoint. When there are more
+        than that, the batches are sent concurrently.
+
+        requests is a list of paths, (path, args) pairs, or (path, args,
+        item_callback) triples. Each item_callback is called with the
+        decoded result of its own request, and callback, if given, with the
+        list of all the results in order. Failed items are logged and
+        passed as None, without affecting the other items::
+
+            self.facebook_batch_request(
+                ["/" + uid for uid in uids],
+                access_token=self.settings["facebook_app_token"],
+                callback=self.async_callback(self._on_profiles))
+        """
+        items = []
+        for request in requests:
+            if isinstance(request, basestring):
+                request = (request, {})
+            if len(request) == 2:
+                request = tuple(request) + (None,)
+            items.append(request)
+        fetches = []
+        for start in xrange(0, len(items), self._GRAPH_BATCH_SIZE):
+            chunk = items[start:start + self._GRAPH_BATCH_SIZE]
+            batch = []
+            for path, args, item_callback in chunk:
+                relative_url = path.lstrip("/")
+                if args:
+                    relative_url += "?" + urllib.urlencode(args)
+                batch.append({"method": "GET", "relative_url": relative_url})
+            post_args = {"batch": escape.json_encode(batch)}
+            if access_token:
+                post_args["access_token"] = access_token
+            fetches.append(("https://graph.facebook.com",
+                            dict(method="POST",
+                                 body=urllib.urlencode(post_args)),
+                            functools.partial(self._on_facebook_batch_request,
+                                              [item[0] for item in chunk])))
+        _fetch_many(fetches, self.async_callback(
+            self._on_facebook_batch_requests, items, callback),
+            _provider_http(self, "facebook_graph", access_token))
+
+    def _on_facebook_batch_request(self, paths, callback, response):
+        if response.error:
+            logging.warning("Error response %s fetching Graph batch",
+                            response.error)
+            callback([None] * len(paths))
+            return
+        results = []
+        # The batch response can be large; decode its items one at a time.
+        # Items past a malformed part of the response are passed as None.
+        try:
+            for path, item in itertools.izip(paths, response.iter_json()):
+                results.append(self._parse_facebook_batch_item(path, item))
+        except Exception:
+            logging.warning("Malformed Graph batch response", exc_info=True)
+        results.extend([None] * (len(paths) - len(results)))
+        callback(results)
+
+    def _parse_facebook_batch_item(self, path, item):
+        if item is None:
+            logging.warning("No response fetching %s in Graph batch", path)
+            return None
+        try:
+            code = item.get("code")
+            if code < 200 or code >= 300:
+                logging.warning("Error response %s fetching %s in Graph batch",
+                                code, path)
+                return None
+            return escape.json_decode(item["body"])
+        except Exception:
+            logging.warning("Malformed response for %s in Graph batch", path,
+                            exc_info=True)
+            return None
+
+    def _on_facebook_batch_requests(self, items, callback, batches):
+        results = []
+        for start, batch in zip(xrange(0, len(items), self._GRAPH_BATCH_SIZE),
+                                batches):
+            # Keep the results of later batches aligned with their items
+            # when a whole batch failed.
+            size = len(items[start:start + self._GRAPH_BATCH_SIZE])
+            results.extend(batch or [None] * size)
+        for (path, args, item_callback), result in zip(items, results):
+            if item_callback is not None:
+                item_callback(result)
+        if callback is not None:
+            callback(results)
+
+class HMACSignatureMethod(object):
+    """OAuth HMAC signature method using the given hashlib digest.
+
+    The HMAC is keyed once per signer; each signature works on a copy.
+    """
+    def __init__(self, digestmod):
+        self.digestmod = digestmod
+
+    def prepare(self, consumer_token, token, version):
+        if version == "1.0a":
+            key_elems = [urllib.quote(consumer_token["secret"], safe='~')]
+            key_elems.append(urllib.quote(token["secret"], safe='~')
+                             if token else "")
+        else:
+            key_elems = [consumer_token["secret"]]
+            key_elems.append(token["secret"] if token else "")
+        # Secrets may come back as unicode, e.g. from a JSON cookie.
+        return hmac.new(escape.utf8("&".join(key_elems)),
+                        digestmod=self.digestmod)
+
+    def sign(self, key, base_string):
+        hash = key.copy()
+        hash.update(base_string)
+        return binascii.b2a_base64(hash.digest())[:-1]
+
+class RSASHA1SignatureMethod(object):
+    """OAuth RSA-SHA1 signature method.
+
+    Signs with the PEM private key in consumer_token["private_key"], which
+    is parsed once per signer. Requires PyCrypto.
+    """
+    def prepare(self, consumer_token, token, version):
+        try:
+            from Crypto.PublicKey import RSA
+            from Crypto.Signature import PKCS1_v1_5
+        except ImportError:
+            raise Exception("PyCrypto is required to use RSA-SHA1 OAuth "
+                            "signatures.")
+        return PKCS1_v1_5.new(RSA.importKey(consumer_token["private_key"]))
+
+    def sign(self, key, base_string):
+        from Crypto.Hash import SHA
+        return binascii.b2a_base64(key.sign(SHA.new(base_string)))[:-1]
+
+_oauth_signature_methods = {
+    "HMAC-SHA1": HMACSignatureMethod(hashlib.sha1),
+    "HMAC-SHA256": HMACSignatureMethod(hashlib.sha256),
+    "RSA-SHA1": RSASHA1SignatureMethod(),
+}
+
+def register_oauth_signature_method(name, method):
+    """Registers an OAuth signature method under the given name.
+
+    method must implement prepare(consumer_token, token, version), returning
+    the key material for a signer, and sign(key, base_string), returning the
+    signature.
     """
-    parts = urlparse.urlparse(url)
-    scheme, netloc, path = parts[:3]
-    normalized_url = scheme.lower() + "://" + netloc.lower() + path
+    _oauth_signature_methods[name] = method
 
-    base_elems = []
-    base_elems.append(method.upper())
-    base_elems.append(normalized_url)
-    base_elems.append("&".join("%s=%s" % (k, _oauth_escape(str(v)))
-                               for k, v in sorted(parameters.items())))
-    base_string =  "&".join(_oauth_escape(e) for e in base_elems)
+class OAuthSigner(object):
+    """Computes OAuth signatures for a consumer token and an optional
+    request or access token.
 
-    key_elems = [consumer_token["secret"]]
-    key_elems.append(token["secret"] if token else "")
-    key = "&".join(key_elems)
+    The key material of the signature method is prepared once per signer,
+    and the escaped values of the parameters that are the same for every
+    request (consumer key, token, signature method and version) are
+    memoized. Normalized URLs are cached module-wide. Use get_oauth_signer()
+    to share signers across requests.
 
-    hash = hmac.new(key, base_string, hashlib.sha1)
-    return binascii.b2a_base64(hash.digest())[:-1]
+    See http://oauth.net/core/1.0a/#signing_process
+    """
+    _STATIC_PARAMETERS = frozenset(["oauth_consumer_key", "oauth_token",
+                                    "oauth_signature_method",
+                                    "oauth_version"])
+
+    def __init__(self, consumer_token, token=None, version="1.0a",
+                 signature_method="HMAC-SHA1"):
+        try:
+            self.method = _oauth_signature_methods[signature_method]
+        except KeyError:
+            raise Exception("Unknown OAuth signature method %s" %
+                            signature_method)
+        self.key = self.method.prepare(consumer_token, token, version)
+        self._escaped = {}
+
+    def sign(self, method, url, parameters={}):
+        """Returns the signature of the given request."""
+        escaped = self._escaped
+        static = self._STATIC_PARAMETERS
+        pairs = []
+        for k, v in sorted(parameters.items()):
+            if k in static:
+                pair = escaped.get((k, v))
+                if pair is None:
+                    pair = escaped[k, v] = "%s=%s" % (k, _oauth_escape(str(v)))
+            else:
+                pair = "%s=%s" % (k, _oauth_escape(str(v)))
+            pairs.append(pair)
+        base_string = "&".join((_oauth_escape(method.upper()),
+                                _oauth_normalized_url(url),
+                                _oauth_escape("&".join(pairs))))
+        return self.method.sign(self.key, base_string)
+
+    def sign_many(self, requests):
+        """Returns the signatures of a list of (method, url, parameters)
+        requests."""
+        return [self.sign(method, url, parameters)
+                for method, url, parameters in requests]
+
+_oauth_signers = stores.MemoryStore(max_size=1000)
+_oauth_normalized_urls = stores.MemoryStore(max_size=1000)
+
+def get_oauth_signer(consumer_token, token=None, version="1.0a",
+                     signature_method="HMAC-SHA1"):
+    """Returns a shared OAuthSigner for the given tokens."""
+    key = (consumer_token["key"], consumer_token["secret"],
+           consumer_token.get("private_key"), version, signature_method)
+    if token:
+        key += (token["key"], token["secret"])
+    signer = _oauth_signers.get(key)
+    if signer is None:
+        signer = OAuthSigner(consumer_token, token, version, signature_method)
+        _oauth_signers.set(key, signer)
+    return signer
+
+def _oauth_normalized_url(url):
+    """Returns the escaped, normalized form of url used in base strings."""
+    normalized_url = _oauth_normalized_urls.get(url)
+    if normalized_url is None:
+        parts = urlparse.urlparse(url)
+        scheme, netloc, path = parts[:3]
+        normalized_url = _oauth_escape(
+            scheme.lower() + "://" + netloc.lower() + path)
+        _oauth_normalized_urls.set(url, normalized_url)
+    return normalized_url
+
+def _oauth_signature(consumer_token, method, url, parameters={}, token=None):
+    """Calculates the HMAC-SHA1 OAuth signature for the given request.
+
+    See http://oauth.net/core/1.0/#signing_process
+    """
+    return get_oauth_signer(consumer_token, token, "1.0").sign(
+        method, url, parameters)
 
 def _oauth10a_signature(consumer_token, method, url, parameters={}, token=None):
     """Calculates the HMAC-SHA1 OAuth 1.0a signature for the given request.
 
     See http://oauth.net/core/1.0a/#signing_process
     """
-    parts = urlparse.urlparse(url)
-    scheme, netloc, path = parts[:3]
-    normalized_url = scheme.lower() + "://" + netloc.lower() + path
-
-    base_elems = []
-    base_elems.append(method.upper())
-    base_elems.append(normalized_url)
-    base_elems.append("&".join("%s=%s" % (k, _oauth_escape(str(v)))
-                               for k, v in sorted(parameters.items())))
-
-    base_string =  "&".join(_oauth_escape(e) for e in base_elems)
-    key_elems = [urllib.quote(consumer_token["secret"], safe='~')]
-    key_elems.append(urllib.quote(token["secret"], safe='~') if token else "")
-    key = "&".join(key_elems)
-
-    hash = hmac.new(key, base_string, hashlib.sha1)
-    return binascii.b2a_base64(hash.digest())[:-1]
+    return get_oauth_signer(consumer_token, token, "1.0a").sign(
+        method, url, parameters)
+
+_OPENID_AX_NS = u"http://openid.net/srv/ax/1.0"
+_OPENID_STANDARD_AX_ATTRS = frozenset(["email", "language", "username"])
+
+def _openid_parse_ax(arguments, signed=None):
+    """Returns a dict mapping AX type URIs to values from the given request
+    arguments, in a single pass over them.
+
+    If signed is given, only the fields it names (without the "openid."
+    prefix) are used.
+    """
+    if signed is not None:
+        signed = frozenset(signed)
+    ax_namespaces = set()
+    types = {}
+    values = {}
+    for name, value in arguments.iteritems():
+        if not name.startswith("openid."):
+            continue
+        if signed is not None and name[7:] not in signed:
+            continue
+        value = value[-1].strip()
+        parts = name.split(".", 3)
+        if len(parts) == 3:
+            if parts[1] == "ns" and value == _OPENID_AX_NS:
+                ax_namespaces.add(parts[2])
+        elif len(parts) == 4:
+            if parts[2] == "type":
+                types[parts[1], parts[3]] = value
+            elif parts[2] == "value":
+                values[parts[1], parts[3]] = value
+    attributes = {}
+    for (ns, alias), uri in types.iteritems():
+        if ns in ax_namespaces and uri not in attributes:
+            attributes[uri] = values.get((ns, alias), u"")
+    return attributes
+
+def _openid_parse_kv(body):
+    """Parses an OpenID key-value form response body."""
+    values = {}
+    for line in body.splitlines():
+        if ":" in line:
+            key, value = line.split(":", 1)
+            values[key.strip()] = value.strip()
+    return values
+
+def _report_rate_limited(response, on_rate_limited):
+    """Calls on_rate_limited with the seconds to wait before trying again
+    and returns True if response refused the call for being rate limited
+    and on_rate_limited is given."""
+    if on_rate_limited is None:
+        return False
+    retry_after = ratelimit.get_retry_after(response)
+    if retry_after is None:
+        return False
+    logging.info("Rate limited fetching %s, retry in %ds",
+                 response.request.url, retry_after)
+    on_rate_limited(retry_after)
+    return True
+
+def _provider_http(handler, provider, token):
+    """Returns the HTTP client to call a provider API with, scheduled by
+    the handler's _RATE_LIMITER if it has one. token identifies the
+    credentials the calls are made with."""
+    http = httpclient.AsyncHTTPClient()
+    limiter = getattr(handler, "_RATE_LIMITER", None)
+    if limiter is None:
+        return http
+    return ratelimit.RateLimitedHTTPClient(
+        http, limiter, provider, token, handler._RATE_LIMIT_PRIORITY)
+
+def _provider_fetch(http, cache, cache_key, path, url, fetch_args, callback):
+    """Fetches url with http, going through the given ResponseCache if the
+    request has a cache_key."""
+    if cache is None or cache_key is None:
+        http.fetch(url, callback=callback, **fetch_args)
+    else:
+        cache.fetch(http, cache_key, path, url, callback, **fetch_args)
+
+def _normalize_requests(requests):
+    """Yields (path, args) pairs from a list of paths or (path, args)."""
+    for request in requests:
+        if isinstance(request, basestring):
+            yield request, {}
+        else:
+            path, args = request
+            yield path, dict(args)
+
+def _fetch_many(fetches, callback, http=None):
+    """Starts all the given fetches at once and calls callback with the list
+    of their results.
+
+    fetches is a list of (url, fetch_args, on_response) tuples, where
+    on_response(callback, response) parses a response the same way the
+    _on_*_request methods do.
+    """
+    if http is None:
+        http = httpclient.AsyncHTTPClient()
+    futures = [http.fetch(url, **fetch_args)
+               for url, fetch_args, on_response in fetches]
+    results = [None] * len(fetches)
+    def collect(index):
+        def set_result(value):
+            results[index] = value
+        return set_result
+    for index, future in enumerate(futures):
+        on_response = fetches[index][2]
+        try:
+            on_response(collect(index), future.get_result())
+        except Exception:
+            logging.error("Exception parsing response for %s",
+                          fetches[index][0], exc_info=True)
+    callback(results)
 
 def _oauth_escape(val):
     if isinstance(val, unicode):
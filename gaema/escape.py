@@ -24,6 +24,7 @@ import htmlentitydefs
 import re
 import sys
 import urllib
+import zlib
 
 # Python3 compatibility:  On python2.5, introduce the bytes alias from 2.6
 try: bytes
@@ -41,23 +42,32 @@ try:
     assert hasattr(json, "loads") and hasattr(json, "dumps")
     _json_decode = json.loads
     _json_encode = json.dumps
+    _json_encode_compact = lambda v: json.dumps(v, separators=(",", ":"))
+    _json_decoder = json.JSONDecoder()
 except Exception:
     try:
         import simplejson
         _json_decode = lambda s: simplejson.loads(_unicode(s))
         _json_encode = lambda v: simplejson.dumps(v)
+        _json_encode_compact = lambda v: simplejson.dumps(
+            v, separators=(",", ":"))
+        _json_decoder = simplejson.JSONDecoder()
     except ImportError:
         try:
             # For Google AppEngine
             from django.utils import simplejson
             _json_decode = lambda s: simplejson.loads(_unicode(s))
             _json_encode = lambda v: simplejson.dumps(v)
+            _json_encode_compact = lambda v: simplejson.dumps(
+                v, separators=(",", ":"))
+            _json_decoder = simplejson.JSONDecoder()
         except ImportError:
             def _json_decode(s):
                 raise NotImplementedError(
                     "A JSON parser is required, e.g., simplejson at "
                     "http://pypi.python.org/pypi/simplejson/")
-            _json_encode = _json_decode
+            _json_encode = _json_encode_compact = _json_decode
+            _json_decoder = None
 
 
 _XHTML_ESCAPE_RE = re.compile('[&<>"]')
@@ -89,6 +99,69 @@ def json_decode(value):
     return _json_decode(to_basestring(value))
 
 
+def json_encode_compact(value):
+    """JSON-encodes the given Python object without whitespace, as a UTF-8
+    byte string. Meant for storage; use json_encode() for HTML."""
+    return utf8(_json_encode_compact(value))
+
+
+def compress(value, min_size=0):
+    """Returns a (compressed, value) pair: value is zlib compressed if it
+    is at least min_size bytes long and that makes it smaller."""
+    if len(value) >= min_size:
+        compressed = zlib.compress(value)
+        if len(compressed) < len(value):
+            return True, compressed
+    return False, value
+
+
+def decompress(value, compressed):
+    """Reverses compress()."""
+    if compressed:
+        return zlib.decompress(value)
+    return value
+
+
+def time_independent_equals(a, b):
+    """Compares two strings in time independent of where they differ, for
+    checking signatures."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+_JSON_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+def json_decode_array(value):
+    """Yields the items of the given JSON array one at a time.
+
+    Each item is decoded as the iteration reaches it, so large arrays can
+    be processed without holding all their decoded items in memory.
+    """
+    if _json_decoder is None:
+        _json_decode(value)
+    value = to_basestring(value)
+    skip = _JSON_WHITESPACE_RE.match
+    pos = skip(value).end()
+    if value[pos:pos + 1] != "[":
+        raise ValueError("Expecting a JSON array at %d" % pos)
+    pos = skip(value, pos + 1).end()
+    if value[pos:pos + 1] == "]":
+        return
+    while True:
+        item, pos = _json_decoder.raw_decode(value, pos)
+        yield item
+        pos = skip(value, pos).end()
+        char = value[pos:pos + 1]
+        if char == "]":
+            return
+        if char != ",":
+            raise ValueError("Expecting , or ] at %d" % pos)
+        pos = skip(value, pos + 1).end()
+
+
 def squeeze(value):
     """Replace all sequences of whitespace chars with a single space."""
     return re.sub(r"[\x00-\x20]+", " ", value).strip()
@@ -5,40 +5,997 @@
 
     HTTP client to support `tornado.auth` on Google App Engine.
 
+    The actual network I/O is delegated to a transport. On App Engine the
+    default transport is `urlfetch`; elsewhere a process-wide pool of
+    keep-alive connections is used, so repeated calls to the same provider
+    host don't pay a new TCP/TLS handshake each time.
+
+    Requests are started without blocking and return a `Future`; the
+    callback-style `fetch()` simply waits on it. On App Engine the futures
+    are backed by urlfetch RPCs, elsewhere by a small pool of worker threads.
+
     :copyright: 2010 by tipfy.org.
     :license: Apache License Version 2.0. See LICENSE.txt for more details.
 """
-import functools
+import hashlib
+import httplib
 import logging
+import Queue
+import random
+import threading
+import time
+import urlparse
+
+from gaema import escape
+from gaema import stores
+from gaema.httputil import HTTPHeaders
 
-from google.appengine.api import urlfetch
+try:
+    from google.appengine.api import urlfetch
+except ImportError:
+    urlfetch = None
+
+try:
+    _buffer = memoryview
+except NameError:
+    # Python 2.5 and 2.6 on App Engine.
+    _buffer = buffer
 
 
 class HttpResponseError(object):
-    """A dummy response used when urlfetch raises an exception."""
-    code = 404
-    body = '404 Not Found'
-    error = 'Error 404'
+    """The response used when a request fails without an HTTP response,
+    e.g. on a timeout or a refused connection.
+
+    Like Tornado, it uses code 599; `error` describes the failure.
+    """
+    code = 599
+    body = ''
+
+    def __init__(self, request=None, error=None, request_time=None,
+                 exception=None):
+        self.request = request
+        self.error = error or 'Error 599'
+        self.request_time = request_time
+        self.exception = exception
+        self.headers = {}
+
+    def __repr__(self):
+        return '<HttpResponseError %s>' % self.error
+
+
+class TransportError(Exception):
+    """Raised by a transport when a request could not be completed."""
+
+
+class ResponseTooLarge(TransportError):
+    """Raised by a transport when a response exceeds the `max_size` of its
+    request."""
+
+
+class Future(object):
+    """The pending result of an asynchronous operation.
+
+    :param waiter:
+        Optional callable that drives the operation to completion, e.g.
+        `rpc.wait`. Without it `wait()` blocks until another thread sets
+        the result.
+    """
+    def __init__(self, waiter=None):
+        self._waiter = waiter
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def done(self):
+        """Returns whether the result is set and its callbacks have run."""
+        return self._event.isSet()
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._set_done()
+
+    def _set_done(self):
+        self._lock.acquire()
+        try:
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        # Callbacks run before waiters are woken up, so anything they chain
+        # (e.g. a retry) is in place once wait() returns.
+        try:
+            for fn in callbacks:
+                self._run_callback(fn)
+        finally:
+            self._event.set()
+
+    def _run_callback(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            logging.error('Exception in future callback %r', fn,
+                          exc_info=True)
+
+    def add_done_callback(self, fn):
+        """Calls `fn(future)` once the result is available. Exceptions
+        raised by `fn` are logged."""
+        self._lock.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        self._run_callback(fn)
+
+    def wait(self):
+        if self._event.isSet():
+            return
+        if self._waiter is not None:
+            self._waiter()
+        self._event.wait()
+
+    def get_result(self):
+        """Waits for the operation and returns its result, or raises the
+        exception it failed with."""
+        # Callbacks of this future may get its result before waiters wake.
+        if not self._done:
+            self.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def map(self, fn):
+        """Returns a new future resolving to `fn(self)` once this one is
+        done."""
+        mapped = Future(waiter=self.wait)
+        def on_done(future):
+            try:
+                mapped.set_result(fn(future))
+            except Exception, e:
+                mapped.set_exception(e)
+        self.add_done_callback(on_done)
+        return mapped
+
+
+def wait_all(futures):
+    """Waits for all the given futures and returns their results in order.
+
+    All the futures are already in flight, so the total time is that of the
+    slowest one rather than the sum of all of them.
+    """
+    return [future.get_result() for future in futures]
+
+
+class HTTPRequest(object):
+    """A single HTTP request, as seen by the transports.
+
+    Transports may only send a request twice if it is `idempotent`, which
+    defaults to true for GET and HEAD requests.
+    """
+    def __init__(self, url, method="GET", headers=None, body=None,
+                 deadline=10, follow_redirects=True, max_size=None,
+                 idempotent=None):
+        self.url = url
+        self.method = method
+        self.headers = headers or {}
+        self.body = body
+        self.deadline = deadline
+        self.follow_redirects = follow_redirects
+        self.max_size = max_size
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+        self.idempotent = idempotent
+        # Set by the transport when it actually starts sending the request.
+        self.started = None
+
+    def check_size(self, size):
+        """Raises `ResponseTooLarge` if `size` exceeds `max_size`."""
+        if self.max_size is not None and size > self.max_size:
+            raise ResponseTooLarge('Response from %s exceeds %d bytes'
+                                   % (self.url, self.max_size))
+
+
+class HTTPResponse(object):
+    """The response returned by a transport.
+
+    `code`, `body` and `error` follow the attributes the auth mixins expect;
+    `status_code`, `content` and `headers` are kept for code written against
+    urlfetch results.
+
+    `body` is the raw response body as received from the transport. Use
+    `buffer` to slice it without copying, and `iter_json()` to decode large
+    JSON arrays one item at a time.
+    """
+    exception = None
+
+    def __init__(self, request, code, headers=None, body='',
+                 request_time=None):
+        self.request = request
+        self.code = code
+        self.headers = headers or {}
+        self.body = body
+        self.request_time = request_time
+        if code < 200 or code >= 300:
+            self.error = 'Error %d' % code
+        else:
+            self.error = None
+
+    @property
+    def status_code(self):
+        return self.code
+
+    @property
+    def content(self):
+        return self.body
+
+    @property
+    def buffer(self):
+        """A read-only view of the body."""
+        return _buffer(self.body)
+
+    def iter_json(self):
+        """Yields the items of a JSON array body as they are decoded."""
+        return escape.json_decode_array(self.body)
+
+    def __repr__(self):
+        return '<HTTPResponse %d %s>' % (self.code, self.request.url)
+
+
+class UrlfetchTransport(object):
+    """Transport using `google.appengine.api.urlfetch` RPCs."""
+    def fetch(self, request):
+        return self.fetch_async(request).get_result()
+
+    def fetch_async(self, request):
+        request.started = time.time()
+        rpc = urlfetch.create_rpc(deadline=request.deadline)
+        future = Future(waiter=rpc.wait)
+        def on_complete():
+            try:
+                result = rpc.get_result()
+            except urlfetch.Error, e:
+                future.set_exception(TransportError(str(e)))
+                return
+            # urlfetch has already downloaded the whole body by now, so the
+            # limit only keeps it from being processed any further.
+            try:
+                request.check_size(len(result.content))
+            except ResponseTooLarge, e:
+                future.set_exception(e)
+            else:
+                future.set_result(HTTPResponse(request, result.status_code,
+                                               headers=result.headers,
+                                               body=result.content))
+        rpc.callback = on_complete
+        urlfetch.make_fetch_call(rpc, request.url, payload=request.body,
+                                 method=request.method,
+                                 headers=request.headers,
+                                 follow_redirects=request.follow_redirects)
+        return future
+
+
+class _WorkerPool(object):
+    """Daemon threads running blocking fetches for `fetch_async()`."""
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._start()
+        self._queue.put((future, fn, args))
+        return future
+
+    def _start(self):
+        if len(self._threads) >= self.num_workers:
+            return
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.num_workers:
+                thread = threading.Thread(target=self._run)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            future, fn, args = self._queue.get()
+            try:
+                try:
+                    result = fn(*args)
+                except Exception, e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            except Exception:
+                # Keep the worker alive whatever the future's callbacks do.
+                logging.error('Exception completing %r', fn, exc_info=True)
+
+
+class _ConnectionPool(object):
+    """Idle keep-alive connections to a single (scheme, host, port)."""
+    def __init__(self, scheme, netloc, max_size, idle_timeout, max_requests):
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = netloc
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """Returns a `(connection, requests_served)` pair, reusing an idle
+        connection if a fresh enough one is available."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            while self._idle:
+                conn, served, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, served
+                conn.close()
+        finally:
+            self._lock.release()
+        conn = self.connection_class(self.netloc, timeout=timeout)
+        return conn, 0
+
+    def release(self, conn, served):
+        """Puts a connection back in the pool, or closes it if it has served
+        enough requests or the pool is full."""
+        if served >= self.max_requests:
+            conn.close()
+            return
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, served, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for conn, served, last_used in idle:
+            conn.close()
+
+
+class PooledTransport(object):
+    """Transport keeping keep-alive connections per provider host.
+
+    :param max_size:
+        Maximum number of idle connections kept per host.
+    :param idle_timeout:
+        Seconds an idle connection is kept before being discarded.
+    :param max_requests:
+        Number of requests served by a connection before it is closed.
+    :param num_workers:
+        Number of threads running requests started with `fetch_async()`.
+    """
+    max_redirects = 5
+
+    def __init__(self, max_size=4, idle_timeout=30, max_requests=100,
+                 num_workers=8):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._workers = _WorkerPool(num_workers)
+
+    def _get_pool(self, scheme, netloc):
+        key = (scheme, netloc)
+        self._lock.acquire()
+        try:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = _ConnectionPool(
+                    scheme, netloc, self.max_size, self.idle_timeout,
+                    self.max_requests)
+            return pool
+        finally:
+            self._lock.release()
+
+    def fetch(self, request):
+        request.started = time.time()
+        url = request.url
+        method = request.method
+        body = request.body
+        for i in xrange(self.max_redirects + 1):
+            code, headers, content = self._fetch_once(url, method,
+                                                      request.headers, body,
+                                                      request.deadline,
+                                                      request)
+            location = headers.get('location')
+            if not (request.follow_redirects and location and
+                    code in (301, 302, 303, 307)):
+                break
+            url = urlparse.urljoin(url, location)
+            if code == 303 or (code in (301, 302) and method == 'POST'):
+                method, body = 'GET', None
+        return HTTPResponse(request, code, headers=headers, body=content)
+
+    def fetch_async(self, request):
+        return self._workers.submit(self.fetch, request)
+
+    def _fetch_once(self, url, method, headers, body, timeout, request):
+        scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
+        if params:
+            path += ';' + params
+        if query:
+            path += '?' + query
+        pool = self._get_pool(scheme, netloc)
+        headers = dict(headers)
+        if body is not None and method == 'POST':
+            headers.setdefault('Content-Type',
+                               'application/x-www-form-urlencoded')
+        # A pooled connection may have been closed by the server while
+        # idle, so a failure on a reused connection is retried once on a
+        # fresh one. Once the request may have reached the server, that is
+        # only done for idempotent requests, so e.g. a POST isn't repeated.
+        idempotent = request.idempotent or method in ('GET', 'HEAD')
+        for attempt in (0, 1):
+            conn, served = pool.acquire(timeout)
+            sent = False
+            try:
+                conn.request(method, path or '/', body, headers)
+                sent = True
+                response = conn.getresponse()
+                content = self._read(response, request)
+            except (httplib.HTTPException, IOError), e:
+                conn.close()
+                if served and not attempt and (idempotent or not sent):
+                    continue
+                raise TransportError(str(e))
+            except ResponseTooLarge:
+                conn.close()
+                raise
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            pool.release(conn, served + 1)
+        return response.status, HTTPHeaders(response.getheaders()), content
+
+    def _read(self, response, request):
+        """Reads the response body, without reading past `max_size`."""
+        if request.max_size is None:
+            return response.read()
+        length = response.getheader('content-length')
+        if length and length.isdigit():
+            request.check_size(int(length))
+        content = response.read(request.max_size + 1)
+        request.check_size(len(content))
+        return content
+
+    def close(self):
+        """Closes all idle connections."""
+        self._lock.acquire()
+        try:
+            pools = self._pools.values()
+        finally:
+            self._lock.release()
+        for pool in pools:
+            pool.clear()
+
+
+class CircuitBreaker(object):
+    """Tracks the health of a single host.
+
+    The circuit is `CLOSED` while the host works. After `failure_threshold`
+    consecutive failures (errors, 5xx responses, or calls slower than
+    `slow_call_time` seconds) it opens, and calls fail immediately for
+    `reset_timeout` seconds. It is then `HALF_OPEN`: one probe call is let
+    through, which closes the circuit if it succeeds and opens it again
+    otherwise. A probe whose outcome isn't recorded within `reset_timeout`
+    seconds, e.g. because its RPC was never waited on, is given up and
+    another one is let through.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, slow_call_time=5,
+                 reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.slow_call_time = slow_call_time
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # When the pending probe call was let through, or None.
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        """Returns whether a call may be made now."""
+        self._lock.acquire()
+        try:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN:
+                now = time.time()
+                if self._probe_started is None or \
+                   now - self._probe_started >= self.reset_timeout:
+                    self._probe_started = now
+                    return True
+            return False
+        finally:
+            self._lock.release()
+
+    def record(self, response, elapsed):
+        """Records the outcome of a call."""
+        failed = elapsed > self.slow_call_time or \
+            (response.code >= 500 and
+             not isinstance(response.exception, ResponseTooLarge))
+        self._lock.acquire()
+        try:
+            self._probe_started = None
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or \
+               self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.warning('Circuit for %s opened after %d failures',
+                                    urlparse.urlparse(
+                                        response.request.url).hostname,
+                                    self.failures)
+                self.opened_at = time.time()
+        finally:
+            self._lock.release()
+
+
+def get_circuit_state(host):
+    """Returns the state of the circuit breaker of `host`, one of
+    `CircuitBreaker.CLOSED`, `OPEN` or `HALF_OPEN`."""
+    breaker = AsyncHTTPClient._breakers.get(host)
+    if breaker is None:
+        return CircuitBreaker.CLOSED
+    return breaker.state
+
+
+def _create_default_transport():
+    if urlfetch is not None:
+        return UrlfetchTransport()
+    return PooledTransport()
 
 
 class AsyncHTTPClient(object):
-    """An non-blocking HTTP client that uses `google.appengine.api.urlfetch`."""
-    def fetch(self, url, callback, **kwargs):
-        # Replace kwarg keys.
-        kwargs['payload'] = kwargs.pop('body', None)
-        kwargs['deadline'] = 10
-        try:
-          result = urlfetch.fetch(url, **kwargs)
-          code = result.status_code
-          setattr(result, 'body', result.content)
-          if code < 200 or code >= 300:
-            logging.debug(result.body)
-            setattr(result, 'error', 'Error %d' % code)
-          else:
-            setattr(result, 'error', None)
-            logging.debug(result.body)
-        except urlfetch.DownloadError, e:
-          logging.debug(e)
-          result = HttpResponseError()
-        args = () + (result,)
-        return callback(*args)
+    """An non-blocking HTTP client that uses `google.appengine.api.urlfetch`.
+
+    All instances share a process-wide transport unless one is passed
+    explicitly. Use `AsyncHTTPClient.configure()` to replace it, e.g. to
+    tune the connection pool::
+
+        AsyncHTTPClient.configure(PooledTransport(max_size=10))
+
+    `fetch()` without a callback returns a `Future` immediately, so several
+    requests can be in flight at once::
+
+        http = AsyncHTTPClient()
+        futures = [http.fetch(url) for url in urls]
+        responses = wait_all(futures)
+
+    Each call has a deadline budget, in seconds, covering all its attempts:
+    the `deadline` argument, or the one configured for the host, or
+    `default_deadline`. Idempotent requests (GET and HEAD, or any request
+    fetched with `idempotent=True`) failing with a transport error or a
+    5xx response are retried up to `max_retries` times, with jittered
+    exponential backoff, while the budget allows it. Slow providers can be
+    given a shorter budget so they fail fast::
+
+        AsyncHTTPClient.configure(deadlines={'api.twitter.com': 5})
+
+    Calls to a host are also guarded by a `CircuitBreaker`, so while a
+    provider is down they fail immediately with a 599 response instead of
+    waiting for their deadline. Its settings are given to `configure()`
+    as a `circuit_breaker` dict of `CircuitBreaker` arguments.
+    """
+    _transport = None
+    _deadlines = {}
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+    _breaker_args = {}
+
+    #: Deadline budget of calls to hosts without a configured one.
+    default_deadline = 10
+    #: Maximum number of retries of an idempotent request.
+    max_retries = 2
+    #: Base delay of the exponential backoff between retries.
+    backoff = 0.1
+    #: Attempts aren't started with less than this budget left.
+    min_attempt_time = 1
+    retry_codes = (500, 502, 503, 504)
+    #: Fraction of the responses whose body is logged at debug level.
+    log_sample_rate = 0.01
+    #: Number of bytes of the body included in the log.
+    log_body_size = 1024
+
+    def __init__(self, transport=None):
+        if transport is None:
+            transport = AsyncHTTPClient.get_transport()
+        self.transport = transport
+
+    @classmethod
+    def configure(cls, transport=None, deadlines=None, default_deadline=None,
+                  max_retries=None, circuit_breaker=None):
+        """Sets the transport shared by all `AsyncHTTPClient` instances,
+        and the retry and deadline settings.
+
+        :param deadlines:
+            Dict mapping host names to their deadline budget in seconds.
+        """
+        if transport is not None:
+            AsyncHTTPClient._transport = transport
+        if deadlines is not None:
+            AsyncHTTPClient._deadlines = dict(deadlines)
+        if default_deadline is not None:
+            AsyncHTTPClient.default_deadline = default_deadline
+        if max_retries is not None:
+            AsyncHTTPClient.max_retries = max_retries
+        if circuit_breaker is not None:
+            AsyncHTTPClient._breaker_args = dict(circuit_breaker)
+            AsyncHTTPClient._breakers = {}
+
+    @classmethod
+    def get_transport(cls):
+        if AsyncHTTPClient._transport is None:
+            AsyncHTTPClient._transport = _create_default_transport()
+        return AsyncHTTPClient._transport
+
+    def get_deadline(self, url):
+        """Returns the deadline budget of calls to the host of `url`."""
+        host = urlparse.urlparse(url).hostname
+        return self._deadlines.get(host, self.default_deadline)
+
+    def get_circuit_breaker(self, url):
+        """Returns the `CircuitBreaker` of the host of `url`."""
+        host = urlparse.urlparse(url).hostname
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            self._breakers_lock.acquire()
+            try:
+                breaker = self._breakers.get(host)
+                if breaker is None:
+                    breaker = self._breakers[host] = \
+                        CircuitBreaker(**self._breaker_args)
+            finally:
+                self._breakers_lock.release()
+        return breaker
+
+    def fetch(self, url, callback=None, **kwargs):
+        """Fetches the given URL.
+
+        If a callback is given, waits for the response and returns
+        `callback(response)`. Otherwise returns a `Future` resolving to the
+        response without blocking.
+        """
+        if callback is None:
+            return self.fetch_async(url, **kwargs)
+        # The caller waits for the response anyway, so the request runs on
+        # its thread rather than taking one of the transport's workers.
+        return callback(self._fetch(url, True, **kwargs).get_result())
+
+    def fetch_async(self, url, deadline=None, idempotent=None, max_size=None,
+                    **kwargs):
+        """Starts fetching the given URL and returns a `Future`.
+
+        Responses larger than `max_size` bytes are turned into an error
+        response instead of being read further.
+        """
+        return self._fetch(url, False, deadline, idempotent, max_size,
+                           **kwargs)
+
+    def _fetch(self, url, inline, deadline=None, idempotent=None,
+               max_size=None, **kwargs):
+        method = kwargs.get('method', 'GET')
+        if deadline is None:
+            deadline = self.get_deadline(url)
+        request = HTTPRequest(url, method=method,
+                              headers=kwargs.get('headers'),
+                              body=kwargs.get('body'), deadline=deadline,
+                              follow_redirects=kwargs.get('follow_redirects',
+                                                          True),
+                              max_size=max_size, idempotent=idempotent)
+        max_retries = 0
+        if request.idempotent:
+            max_retries = self.max_retries
+        return _RetryingFetch(self, request, max_retries, inline).future
+
+    def _should_retry(self, response):
+        if isinstance(response.exception, ResponseTooLarge):
+            return False
+        return response.code == 599 or response.code in self.retry_codes
+
+    def _on_response(self, future, request, start):
+        request_time = time.time() - start
+        try:
+            result = future.get_result()
+        except TransportError, e:
+            logging.debug('Error fetching %s: %s', request.url, e)
+            result = HttpResponseError(request, str(e), exception=e)
+        else:
+            self._log_response(result)
+        result.request_time = request_time
+        return result
+
+    def _log_response(self, response):
+        # Bodies can be large, so only a truncated sample of them is logged,
+        # and only when debug logging is enabled at all.
+        if not logging.getLogger().isEnabledFor(logging.DEBUG) or \
+           random.random() >= self.log_sample_rate:
+            return
+        logging.debug('Response %d from %s (%d bytes): %r', response.code,
+                      response.request.url, len(response.body),
+                      response.body[:self.log_body_size])
+
+
+class _RetryingFetch(object):
+    """Runs the attempts of a single `AsyncHTTPClient` call within its
+    deadline budget.
+
+    With `inline`, the attempts run on the calling thread with the
+    transport's blocking `fetch()`, and the future is done on return.
+    """
+    def __init__(self, client, request, max_retries, inline=False):
+        self.client = client
+        self.request = request
+        self.max_retries = max_retries
+        self.inline = inline
+        self._retry = None
+        self.start = time.time()
+        self.attempt = 0
+        self.future = Future(waiter=self._wait)
+        self._current = None
+        # Notified whenever _current changes.
+        self._started = threading.Condition()
+        self.breaker = client.get_circuit_breaker(request.url)
+        if not self.breaker.allow():
+            host = urlparse.urlparse(request.url).hostname
+            self.future.set_result(HttpResponseError(
+                request, 'Circuit open for %s' % host, 0))
+            return
+        if inline:
+            self._run_inline()
+        else:
+            self._start_attempt(request.deadline)
+
+    def _run_inline(self):
+        deadline = self.request.deadline
+        while True:
+            self._start_attempt(deadline)
+            if self._retry is None:
+                return
+            delay, deadline = self._retry
+            self._retry = None
+            time.sleep(delay)
+
+    def _start_attempt(self, deadline):
+        self._attempt_start = time.time()
+        request = self.request
+        attempt = self._attempt = HTTPRequest(
+            request.url, method=request.method, headers=request.headers,
+            body=request.body, deadline=deadline,
+            follow_redirects=request.follow_redirects,
+            max_size=request.max_size, idempotent=request.idempotent)
+        try:
+            if self.inline:
+                current = Future()
+                current.set_result(self.client.transport.fetch(attempt))
+            else:
+                current = self.client.transport.fetch_async(attempt)
+        except Exception, e:
+            current = Future()
+            current.set_exception(e)
+        self._set_current(current)
+        current.add_done_callback(self._on_attempt)
+
+    def _wait(self):
+        # Drives every attempt in turn. While a retry is waiting for its
+        # backoff delay there is no attempt to drive, so block until the
+        # timer starts it.
+        while not self.future.done():
+            self._started.acquire()
+            try:
+                while self._current is None and not self.future.done():
+                    self._started.wait()
+                current = self._current
+            finally:
+                self._started.release()
+            if current is None:
+                continue
+            current.wait()
+            # An attempt can finish before _on_attempt is added to it, so
+            # wait until _on_attempt has taken it.
+            self._started.acquire()
+            try:
+                while self._current is current and not self.future.done():
+                    self._started.wait()
+            finally:
+                self._started.release()
+
+    def _set_current(self, current):
+        self._started.acquire()
+        try:
+            self._current = current
+            self._started.notifyAll()
+        finally:
+            self._started.release()
+
+    def _finish(self, response=None, exception=None):
+        if exception is not None:
+            self.future.set_exception(exception)
+        else:
+            self.future.set_result(response)
+        self._set_current(None)
+
+    def _on_attempt(self, future):
+        self._set_current(None)
+        try:
+            response = self.client._on_response(future, self.request,
+                                                self.start)
+        except Exception, e:
+            self.breaker.record(HttpResponseError(self.request, str(e)), 0)
+            self._finish(exception=e)
+            return
+        # Time spent queued for a transport worker isn't the host's fault.
+        started = self._attempt.started or self._attempt_start
+        self.breaker.record(response, time.time() - started)
+        if self.attempt < self.max_retries and \
+           self.client._should_retry(response) and self.breaker.allow():
+            delay = random.uniform(0, self.client.backoff * 2 ** self.attempt)
+            remaining = self.request.deadline - (time.time() - self.start)
+            if remaining - delay >= self.client.min_attempt_time:
+                self.attempt += 1
+                logging.info('Retrying %s after %s (attempt %d)',
+                             self.request.url, response.error,
+                             self.attempt + 1)
+                if self.inline:
+                    self._retry = (delay, remaining - delay)
+                    return
+                # Wait for the backoff on a timer rather than in this
+                # callback, which may run on a transport's worker thread.
+                timer = threading.Timer(delay, self._start_attempt,
+                                        [remaining - delay])
+                timer.setDaemon(True)
+                timer.start()
+                return
+        self._finish(response)
+
+
+class ResponseCache(object):
+    """Caches the responses of read-only provider API calls.
+
+    Only paths with a TTL are cached: `ttls` maps path prefixes to the
+    number of seconds their responses stay fresh (the longest matching
+    prefix wins), and `default_ttl` applies to all other paths. POST
+    requests are never cached.
+
+    Expired responses carrying an `ETag` or `Last-Modified` header are
+    revalidated with a conditional request instead of being fetched again.
+    Within `stale_ttl` seconds after expiring, the stale response is served
+    immediately while it is refreshed in the background. On App Engine the
+    refresh is only applied if the urlfetch RPC is waited on before the
+    request ends; otherwise the next call fetches it.
+
+    :param store:
+        A store from `gaema.stores`; defaults to a `MemoryStore`.
+    :param revalidate_ttl:
+        How long expired responses with validators are kept around.
+    """
+    def __init__(self, store=None, ttls=None, default_ttl=0, stale_ttl=0,
+                 revalidate_ttl=3600):
+        if store is None:
+            store = stores.MemoryStore()
+        self.store = store
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.revalidate_ttl = revalidate_ttl
+
+    def ttl(self, path):
+        """Returns the number of seconds responses for `path` are fresh."""
+        match = None
+        for prefix in self.ttls:
+            if path.startswith(prefix) and \
+               (match is None or len(prefix) > len(match)):
+                match = prefix
+        if match is None:
+            return self.default_ttl
+        return self.ttls[match]
+
+    def key(self, provider, path, args, token=None):
+        """Returns the cache key of a GET request, or `None` if responses
+        for `path` aren't cached. `token` identifies the credentials the
+        request is made with, e.g. the OAuth access token key."""
+        if not self.ttl(path):
+            return None
+        parts = repr((provider, path, sorted(args.items()), token))
+        return 'response:' + hashlib.sha1(parts).hexdigest()
+
+    def fetch(self, http, key, path, url, callback, **kwargs):
+        """Calls `callback` with the cached response for `key` if it is
+        fresh, and fetches `url` with `http` otherwise."""
+        ttl = self.ttl(path)
+        entry = self.store.get(key)
+        age = entry and time.time() - entry['stored']
+        if entry and age < ttl:
+            return callback(self._response(url, entry))
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        if entry and age < ttl + self.stale_ttl:
+            try:
+                future = http.fetch(url, headers=headers, **kwargs)
+            except Exception:
+                # The stale entry will do.
+                logging.warning("Couldn't refresh %s", url, exc_info=True)
+            else:
+                future.add_done_callback(
+                    lambda future: self._on_response(key, ttl, entry, future))
+            return callback(self._response(url, entry))
+        future = http.fetch(url, headers=headers, **kwargs)
+        return callback(self._on_response(key, ttl, entry, future))
+
+    def _on_response(self, key, ttl, entry, future):
+        response = future.get_result()
+        if response.code == 304 and entry:
+            entry = dict(entry, stored=time.time())
+        elif response.code == 200:
+            entry = {
+                'body': response.body,
+                'headers': dict(response.headers),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'stored': time.time(),
+            }
+        else:
+            return response
+        keep = self.stale_ttl
+        if entry['etag'] or entry['last_modified']:
+            keep = max(keep, self.revalidate_ttl)
+        self.store.set(key, entry, ttl + keep)
+        return self._response(response.request.url, entry)
+
+    def _response(self, url, entry):
+        return HTTPResponse(HTTPRequest(url), 200,
+                            headers=HTTPHeaders(entry['headers']),
+                            body=entry['body'])
+
+    def delete(self, key):
+        self.store.delete(key)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""
+kay.ext.gaema.migrations
+
+Bulk export, import and rewriting of GAEMAUser entities, e.g. to change
+the key name format or the user data encoding.
+
+Entities are read in cursor batches and written with batch puts, so
+memory use is bounded by the batch size. To try a migration locally,
+call setup_local_datastore() first.
+
+:license: BSD, see LICENSE for more details.
+"""
+
+import logging
+import os
+import time
+
+import simplejson
+from google.appengine.ext import db
+
+from kay.ext.gaema import stores
+from kay.ext.gaema.models import GAEMAUser
+
+CHECKPOINT_KEY_FORMAT = "gaema_migration:%s"
+
+
+def _check_model(model):
+  """Refuses models customizing store_user_data() but not build_entity(),
+  whose extra properties would be lost by the functions below."""
+  if model.store_user_data.im_func is not \
+     GAEMAUser.store_user_data.im_func and \
+     model.build_entity.im_func is GAEMAUser.build_entity.im_func:
+    raise TypeError("%s overrides store_user_data() but not build_entity(); "
+                    "move the customization to build_entity()"
+                    % model.__name__)
+
+
+class MigrationReport(object):
+  """Counts what a bulk run did and how fast it went."""
+
+  def __init__(self, processed=0, written=0, deleted=0, failed=0,
+               elapsed=0.0, cursor=None, done=False):
+    self.processed = processed
+    self.written = written
+    self.deleted = deleted
+    self.failed = failed
+    self.cursor = cursor
+    self.done = done
+    self._elapsed = elapsed
+    self._start = time.time()
+
+  @property
+  def elapsed(self):
+    return self._elapsed + time.time() - self._start
+
+  @property
+  def rate(self):
+    """Entities processed per second."""
+    elapsed = self.elapsed
+    if not elapsed:
+      return 0.0
+    return self.processed / elapsed
+
+  def to_dict(self):
+    return dict(processed=self.processed, written=self.written,
+                deleted=self.deleted, failed=self.failed,
+                elapsed=self.elapsed, cursor=self.cursor, done=self.done)
+
+  def __str__(self):
+    return ("%d processed, %d written, %d deleted, %d failed in %.1fs "
+            "(%.1f entities/s)" % (self.processed, self.written,
+                                   self.deleted, self.failed, self.elapsed,
+                                   self.rate))
+
+
+def iter_batches(model=GAEMAUser, batch_size=500, cursor=None):
+  """Yields (entities, cursor) pairs for consecutive batches of all the
+  entities of model; each cursor resumes after its batch."""
+  while True:
+    query = model.all()
+    if cursor is not None:
+      query.with_cursor(cursor)
+    entities = query.fetch(batch_size)
+    if not entities:
+      return
+    cursor = query.cursor()
+    yield entities, cursor
+    if len(entities) < batch_size:
+      return
+
+
+def migrate_users(transform, model=GAEMAUser, target_model=None, name=None,
+                  batch_size=500, checkpoint_store=None, time_limit=None,
+                  delete_rekeyed=True, cursor=None):
+  """Rewrites the entities of model through transform.
+
+  transform(key_name, user) gets the decoded user data of each entity and
+  returns None to leave it alone, or a (key_name, user) pair to store
+  under target_model, which defaults to model. When the key name changes
+  within the same model, the old entity is deleted unless delete_rekeyed
+  is false. Re-keyed entities may be visited again later in the run, so
+  transform must leave already migrated ones alone::
+
+    def rekey(key_name, user):
+      if key_name.startswith('twitter:id:'):
+        return None
+      return 'twitter:id:%s' % user['id'], user
+
+    migrate_users(rekey, name='rekey-twitter')
+
+  With a name, progress is checkpointed in checkpoint_store (a
+  DatastoreStore by default) after every batch, and calling again with
+  the same name resumes where the previous run stopped. With a
+  time_limit in seconds, the run stops after the batch crossing it;
+  report.done tells whether another call is needed, e.g. from a task
+  that enqueues itself again. Runs without a name are continued by
+  passing report.cursor back as cursor.
+
+  Returns a MigrationReport.
+  """
+  if target_model is None:
+    target_model = model
+  _check_model(target_model)
+  if name is not None and checkpoint_store is None:
+    checkpoint_store = stores.DatastoreStore()
+  report = MigrationReport(cursor=cursor)
+  if name is not None:
+    saved = checkpoint_store.get(CHECKPOINT_KEY_FORMAT % name)
+    if saved is not None:
+      report = MigrationReport(**saved)
+      if report.done:
+        return report
+  start = time.time()
+  for entities, cursor in iter_batches(model, batch_size, report.cursor):
+    puts = []
+    deletes = []
+    for entity in entities:
+      key_name = entity.key().name()
+      try:
+        result = transform(key_name, entity.raw_user_data)
+        if result is None:
+          continue
+        new_key_name, user = result
+        new_entity = target_model.build_entity(new_key_name, user)
+        new_entity.created = entity.created
+        puts.append(new_entity)
+        if new_key_name != key_name and target_model is model and \
+           delete_rekeyed:
+          deletes.append(entity.key())
+      except Exception:
+        report.failed += 1
+        logging.error("Migrating %s failed", key_name, exc_info=True)
+    if puts:
+      db.put(puts)
+      target_model.invalidate_cached([e.key().name() for e in puts])
+    if deletes:
+      db.delete(deletes)
+      model.invalidate_cached([key.name() for key in deletes])
+    report.processed += len(entities)
+    report.written += len(puts)
+    report.deleted += len(deletes)
+    report.cursor = cursor
+    if name is not None:
+      checkpoint_store.set(CHECKPOINT_KEY_FORMAT % name, report.to_dict())
+    logging.info("%s: %s", name or "migration", report)
+    if time_limit is not None and time.time() - start >= time_limit:
+      return report
+  report.done = True
+  if name is not None:
+    checkpoint_store.set(CHECKPOINT_KEY_FORMAT % name, report.to_dict())
+  return report
+
+
+def export_users(fp, model=GAEMAUser, batch_size=500, cursor=None):
+  """Writes the entities of model to the file-like fp, one JSON object per
+  line with their key_name, service and decoded user_data.
+
+  report.cursor can be passed back to continue an interrupted export.
+  """
+  report = MigrationReport(cursor=cursor)
+  for entities, cursor in iter_batches(model, batch_size, cursor):
+    for entity in entities:
+      try:
+        line = simplejson.dumps({
+          "key_name": entity.key().name(),
+          "service": entity.service,
+          "user_data": entity.raw_user_data,
+        }, separators=(",", ":"))
+      except Exception:
+        report.failed += 1
+        logging.error("Exporting %s failed", entity.key().name(),
+                      exc_info=True)
+        continue
+      fp.write(line + "\n")
+      report.written += 1
+    report.processed += len(entities)
+    report.cursor = cursor
+    logging.info("export: %s", report)
+  report.done = True
+  return report
+
+
+def import_users(fp, model=GAEMAUser, batch_size=500, transform=None):
+  """Stores the entities written by export_users() to fp, with batch puts.
+
+  transform works as in migrate_users(). Existing entities with the same
+  key names are overwritten.
+  """
+  _check_model(model)
+  report = MigrationReport()
+  batch = []
+  def flush():
+    if batch:
+      db.put(batch)
+      model.invalidate_cached([e.key().name() for e in batch])
+      report.written += len(batch)
+      del batch[:]
+      logging.info("import: %s", report)
+  for line in fp:
+    if not line.strip():
+      continue
+    report.processed += 1
+    try:
+      record = simplejson.loads(line)
+      key_name, user = record["key_name"], record["user_data"]
+      if transform is not None:
+        result = transform(key_name, user)
+        if result is None:
+          continue
+        key_name, user = result
+      batch.append(model.build_entity(key_name, user))
+    except Exception:
+      report.failed += 1
+      logging.error("Importing line %d failed", report.processed,
+                    exc_info=True)
+      continue
+    if len(batch) >= batch_size:
+      flush()
+  flush()
+  report.done = True
+  return report
+
+
+def setup_local_datastore(app_id="gaema-migrations", datastore_file=None):
+  """Registers the datastore and memcache stubs of the SDK, so the
+  functions above can run in a local shell or test. Without a
+  datastore_file, the datastore lives in memory."""
+  from google.appengine.api import apiproxy_stub_map
+  from google.appengine.api import datastore_file_stub
+  from google.appengine.api.memcache import memcache_stub
+  os.environ["APPLICATION_ID"] = app_id
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub(
+    "datastore_v3",
+    datastore_file_stub.DatastoreFileStub(app_id, datastore_file))
+  apiproxy_stub_map.apiproxy.RegisterStub(
+    "memcache", memcache_stub.MemcacheService())
@@ -9,41 +9,345 @@ Kay authentication model for gaema.
 :license: BSD, see LICENSE for more details.
 """
 
+import datetime
+import hashlib
 import simplejson
 import pickle
 
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
 
+from kay.ext.gaema import escape
+from kay.ext.gaema import stores
+
+# User fields which change on every login without the user having changed.
+# Credentials such as access_token and session_key aren't among them: a
+# new one is always written, since the old one may have been revoked.
+VOLATILE_FIELDS = frozenset([
+  'session_expires', 'expires',
+])
+
+def _digest(data):
+  return hashlib.sha1(simplejson.dumps(data, sort_keys=True,
+                                       separators=(',', ':'),
+                                       default=repr)).hexdigest()
+
+# User fields holding the provider's id for the user, by preference.
+PROVIDER_ID_FIELDS = ('claimed_id', 'id', 'uid', 'facebook_uid')
+USERNAME_FIELDS = ('username', 'screen_name', 'nickname')
+
+def _first_field(user, fields):
+  for field in fields:
+    value = user.get(field)
+    if value:
+      return unicode(value)
+  return None
+
+def get_user_index_values(user):
+  """Returns the values of the indexed GAEMAUser properties for a provider
+  user dict."""
+  email = user.get('email')
+  return {
+    'email': email and email.lower(),
+    'username': _first_field(user, USERNAME_FIELDS),
+    'provider_id': _first_field(user, PROVIDER_ID_FIELDS),
+    'locale': user.get('locale'),
+  }
+
+def get_user_digests(user):
+  """Returns the digests of the identity fields and of the volatile fields
+  of a provider user dict."""
+  identity = {}
+  volatile = {}
+  for k, v in user.iteritems():
+    if k in VOLATILE_FIELDS:
+      volatile[k] = v
+    else:
+      identity[k] = v
+  return _digest(identity), _digest(volatile)
+
+
+class JSONCodec(object):
+  """Encodes user data as compact JSON."""
+  def encode(self, data):
+    return escape.json_encode_compact(data)
+
+  def decode(self, value):
+    return simplejson.loads(value)
+
+# Encoded user data starts with a version byte naming its codec, and a
+# flags byte. Pickles made with protocol 2 start with '\x80' instead.
+USER_DATA_JSON = 1
+_FLAG_ZLIB = 1
+_PICKLE_PROTO = '\x80'
+# User data is only compressed from this size on.
+USER_DATA_COMPRESS_MIN_SIZE = 512
+
+user_data_codecs = {
+  USER_DATA_JSON: JSONCodec(),
+}
+
+def register_user_data_codec(version, codec):
+  """Registers a codec with encode(data) and decode(value) methods, e.g.
+  a msgpack based one, under a version number from 2 to 127."""
+  if version in user_data_codecs or not 1 < version < 128:
+    raise ValueError('Invalid user data codec version %r' % version)
+  user_data_codecs[version] = codec
+
+def encode_user_data(data, version=USER_DATA_JSON):
+  compressed, payload = escape.compress(user_data_codecs[version].encode(data),
+                                        USER_DATA_COMPRESS_MIN_SIZE)
+  flags = compressed and _FLAG_ZLIB or 0
+  return chr(version) + chr(flags) + payload
+
+def decode_user_data(value, allow_pickle=True):
+  """Decodes user data written by encode_user_data(), or pickled by older
+  versions if allow_pickle is true."""
+  if value[:1] == _PICKLE_PROTO:
+    if not allow_pickle:
+      raise ValueError('Pickled user data is not allowed')
+    return pickle.loads(value)
+  codec = user_data_codecs.get(ord(value[:1] or '\x00'))
+  if codec is None:
+    raise ValueError('Unknown user data codec %r' % value[:1])
+  return codec.decode(escape.decompress(value[2:],
+                                       ord(value[1]) & _FLAG_ZLIB))
+
+def is_pickled_user_data(value):
+  return value[:1] == _PICKLE_PROTO
+
+
+# Encoded entities recently read or written by this instance, in front of
+# memcache.
+_local_cache = stores.MemoryStore(max_size=1000)
+
 
 class GAEMAUser(db.Model):
   service = db.StringProperty(required=True)
   user_data = db.BlobProperty(required=True)
+  identity_digest = db.StringProperty(indexed=False)
+  volatile_digest = db.StringProperty(indexed=False)
+  # Copied from user_data when it is stored, for the find_* methods.
+  # Entities stored before these existed get them the next time they are
+  # written; to fill them all at once, run
+  # migrations.migrate_users(lambda key_name, user: (key_name, user)).
+  email = db.StringProperty()
+  username = db.StringProperty()
+  provider_id = db.StringProperty()
+  locale = db.StringProperty()
   created = db.DateTimeProperty(auto_now_add=True)
-  updated = db.DateTimeProperty(auto_now=True)  
+  updated = db.DateTimeProperty(auto_now=True)
+
+  # Changes to volatile fields alone are only written once the stored
+  # entity is older than this many seconds; until then they only update
+  # the cached copies.
+  volatile_write_interval = 3600
+  # Seconds entities are kept in memcache.
+  cache_time = 3600
+  # Seconds entities are kept in the in-process cache. Other instances
+  # don't invalidate it, so keep this short.
+  local_cache_time = 60
+  # Codec version used to encode user data.
+  user_data_version = USER_DATA_JSON
+  # Set to False once all rows are migrated with migrate_user_data(), to
+  # stop unpickling user data altogether.
+  allow_pickle = True
 
   @classmethod
   def get_or_insert(cls, key_name, user):
-    ds_user = cls.get_by_key_name(key_name)
-    if not ds_user or ds_user.raw_user_data != user:
-      ds_user = cls.store_user_data(key_name, user)
+    """Returns the user entity for key_name, storing the given user data if
+    it differs from the stored one.
+
+    The comparison only looks at the digests stored on the entity, which
+    is read through get_cached(), so a returning user costs no datastore
+    operation at all. When only volatile fields such as the session
+    expiry changed, the new data is kept in the cached copies of the
+    entity until the stored one is old enough to be rewritten.
+    """
+    identity, volatile = get_user_digests(user)
+    ds_user = cls.get_cached(key_name)
+    if ds_user is None or ds_user.identity_digest != identity:
+      return cls.store_user_data(key_name, user)
+    if ds_user.volatile_digest != volatile:
+      if datetime.datetime.utcnow() - ds_user.updated >= \
+         datetime.timedelta(seconds=cls.volatile_write_interval):
+        return cls.store_user_data(key_name, user)
+      if ds_user.raw_user_data != user:
+        # volatile_digest still describes the stored entity, so a later
+        # login writes these fields once the interval has passed.
+        ds_user.user_data = encode_user_data(user, cls.user_data_version)
+        cls._set_cached([ds_user])
     return ds_user
 
   @classmethod
   def store_user_data(cls, key_name, user):
-    """You can override this class method for custom model."""
-    ret = cls(key_name=key_name,
-              user_data=pickle.dumps(user, pickle.HIGHEST_PROTOCOL),
-              service=user['_service'])
+    """Stores and returns the entity built by build_entity()."""
+    ret = cls.build_entity(key_name, user)
     ret.put()
     return ret
 
+  @classmethod
+  def build_entity(cls, key_name, user):
+    """Returns a new, unsaved entity holding the given user data.
+
+    You can override this class method for custom model; logins, bulk
+    migrations and imports all build entities with it. Overrides should
+    call this one, or set identity_digest and volatile_digest from
+    get_user_digests(), or get_or_insert() will store the user data on
+    every login.
+    """
+    identity, volatile = get_user_digests(user)
+    return cls(key_name=key_name,
+               user_data=encode_user_data(user, cls.user_data_version),
+               service=user['_service'],
+               identity_digest=identity,
+               volatile_digest=volatile,
+               **get_user_index_values(user))
+
+  @classmethod
+  def find_by_email(cls, email, service=None, limit=20):
+    """Returns the users with the given email address, e.g. to find the
+    other logins of the same person."""
+    query = cls.all().filter('email =', email.lower())
+    if service is not None:
+      query.filter('service =', service)
+    return query.fetch(limit)
+
+  @classmethod
+  def find_by_username(cls, username, service=None, limit=20):
+    query = cls.all().filter('username =', username)
+    if service is not None:
+      query.filter('service =', service)
+    return query.fetch(limit)
+
+  @classmethod
+  def get_by_provider_id(cls, service, provider_id):
+    """Returns the user with the given id at the provider of the service,
+    or None."""
+    return cls.all().filter('service =', service) \
+                    .filter('provider_id =', unicode(provider_id)).get()
+
+  @classmethod
+  def _cache_key(cls, key_name):
+    return '%s:%s' % (cls.kind(), key_name)
+
+  @classmethod
+  def get_cached(cls, key_name):
+    """Like get_by_key_name(), reading through an in-process cache and
+    memcache."""
+    return cls.get_multi([key_name])[0]
+
+  @classmethod
+  def get_multi(cls, key_names):
+    """Returns the entities for the given key names, in order, with None
+    for the missing ones.
+
+    Entities found in neither cache are fetched with a single batch get,
+    so rendering many users costs at most one memcache and one datastore
+    round trip.
+    """
+    cache_keys = [cls._cache_key(key_name) for key_name in key_names]
+    found = {}
+    for cache_key in cache_keys:
+      data = _local_cache.get(cache_key)
+      if data is not None:
+        found[cache_key] = data
+    missing = [cache_key for cache_key in cache_keys
+               if cache_key not in found]
+    if missing:
+      cached = memcache.get_multi(missing, namespace='gaema')
+      for cache_key, data in cached.iteritems():
+        _local_cache.set(cache_key, data, cls.local_cache_time)
+      found.update(cached)
+    missing = [(cache_key, key_name)
+               for cache_key, key_name in zip(cache_keys, key_names)
+               if cache_key not in found]
+    fetched = {}
+    if missing:
+      ds_users = cls.get_by_key_name([key_name for _, key_name in missing])
+      for (cache_key, key_name), ds_user in zip(missing, ds_users):
+        if ds_user is not None:
+          fetched[cache_key] = ds_user
+      cls._set_cached(fetched.values())
+    results = []
+    for cache_key in cache_keys:
+      if cache_key in fetched:
+        results.append(fetched[cache_key])
+      elif cache_key in found:
+        results.append(db.model_from_protobuf(
+          entity_pb.EntityProto(found[cache_key])))
+      else:
+        results.append(None)
+    return results
+
+  @classmethod
+  def _set_cached(cls, ds_users):
+    mapping = {}
+    for ds_user in ds_users:
+      cache_key = cls._cache_key(ds_user.key().name())
+      mapping[cache_key] = db.model_to_protobuf(ds_user).Encode()
+      _local_cache.set(cache_key, mapping[cache_key], cls.local_cache_time)
+    if mapping:
+      memcache.set_multi(mapping, time=cls.cache_time, namespace='gaema')
+
+  @classmethod
+  def invalidate_cached(cls, key_names):
+    """Drops the cached copies of the given entities, e.g. after writing
+    them with db.put()."""
+    cache_keys = [cls._cache_key(key_name) for key_name in key_names]
+    for cache_key in cache_keys:
+      _local_cache.delete(cache_key)
+    memcache.delete_multi(cache_keys, namespace='gaema')
+
+  def put(self, **kwargs):
+    """Stores the entity and refreshes its cached copies."""
+    key = super(GAEMAUser, self).put(**kwargs)
+    self._set_cached([self])
+    return key
+
+  def delete(self, **kwargs):
+    key_name = self.key().name()
+    super(GAEMAUser, self).delete(**kwargs)
+    self.invalidate_cached([key_name])
+
+  @classmethod
+  def migrate_user_data(cls, batch_size=100, cursor=None):
+    """Re-encodes a batch of pickled user data with the current codec.
+
+    Returns the number of entities rewritten and the cursor to pass to the
+    next call, or None once all entities have been visited.
+    """
+    query = cls.all()
+    if cursor is not None:
+      query.with_cursor(cursor)
+    ds_users = query.fetch(batch_size)
+    pickled = [ds_user for ds_user in ds_users
+               if is_pickled_user_data(ds_user.user_data)]
+    for ds_user in pickled:
+      ds_user.user_data = encode_user_data(pickle.loads(ds_user.user_data),
+                                           cls.user_data_version)
+    if pickled:
+      db.put(pickled)
+      cls.invalidate_cached([ds_user.key().name() for ds_user in pickled])
+    if len(ds_users) < batch_size:
+      return len(pickled), None
+    return len(pickled), query.cursor()
+
   @property
   def raw_user_data(self):
-    return pickle.loads(self.user_data)
+    """The decoded user data, decoded once per instance and user_data
+    value."""
+    cached = getattr(self, '_raw_user_data', None)
+    if cached is None or cached[0] is not self.user_data:
+      cached = (self.user_data,
+                decode_user_data(self.user_data, self.allow_pickle))
+      self._raw_user_data = cached
+    return cached[1]
 
   def is_anonymous(self):
     return False
-        
+
   def is_authenticated(self):
     return True
 
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+    gaema.ratelimit
+    ~~~~~~~~~~~~~~~
+
+    Paces provider API calls so they stay within the provider's quota.
+
+    A `RateLimitScheduler` keeps a token bucket per access token and one
+    per provider for the whole application, and tracks the quota the
+    provider reports in its rate limit headers. Calls that would have to
+    wait longer than their priority allows fail immediately with
+    `RateLimitExceeded` instead of being sent and rejected by the provider.
+    `RateLimitedHTTPClient` turns that into a 429 response, so callers
+    handle it like any other error response.
+
+    :license: Apache License Version 2.0. See LICENSE.txt for more details.
+"""
+import logging
+import threading
+import time
+
+from gaema import httpclient
+from gaema import stores
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call can't be made within the caller's priority.
+
+    `retry_after` is the number of seconds after which it may succeed.
+    """
+    def __init__(self, provider, retry_after):
+        Exception.__init__(self, 'Rate limit for %s exceeded, retry in %.1fs'
+                           % (provider, retry_after))
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """Allows `rate` calls per second on average, in bursts of up to
+    `capacity` calls."""
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    def _refill(self, now):
+        # `now` may predate a bucket created after it was taken.
+        if now <= self.updated:
+            return
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now, reserve=0):
+        """Returns how long to wait until a call can be made while leaving
+        `reserve` tokens in the bucket."""
+        self._refill(now)
+        missing = reserve + 1 - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimitScheduler(object):
+    """Schedules the calls made to provider APIs.
+
+    :param rate:
+        Calls per second allowed for each access token.
+    :param burst:
+        Calls each access token may make in a burst.
+    :param app_rate:
+        Calls per second the whole application may make to each provider.
+    :param app_burst:
+        Calls the application may make to each provider in a burst.
+    :param max_wait:
+        Dict mapping priorities to the number of seconds a call may be
+        delayed before `RateLimitExceeded` is raised.
+    :param batch_reserve:
+        Fraction of the application bucket and of the provider reported
+        quota that batch calls may not use, so interactive calls such as
+        logins keep working while background jobs run.
+    """
+    # Rate limit headers, as sent by Twitter.
+    limit_header = 'X-RateLimit-Limit'
+    remaining_header = 'X-RateLimit-Remaining'
+    reset_header = 'X-RateLimit-Reset'
+    # Codes of responses throttling the whole application rather than a
+    # single access token.
+    app_throttle_codes = (420, 503)
+
+    def __init__(self, rate=1, burst=10, app_rate=50, app_burst=100,
+                 max_wait=None, batch_reserve=0.2):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = {INTERACTIVE: 2.0, BATCH: 30.0}
+        if max_wait:
+            self.max_wait.update(max_wait)
+        self.batch_reserve = batch_reserve
+        self.app_rate = app_rate
+        self.app_burst = app_burst
+        self._app_buckets = {}
+        self._buckets = stores.MemoryStore(max_size=10000)
+        self._quotas = stores.MemoryStore(max_size=10000)
+        # Times until which providers asked the application to back off.
+        self._backoffs = stores.MemoryStore(max_size=1000)
+        self._lock = threading.Lock()
+
+    def acquire(self, provider, token=None, priority=INTERACTIVE):
+        """Waits until a call can be made for the given token, or raises
+        `RateLimitExceeded` if that would take longer than `priority`
+        allows."""
+        wait = self.reserve(provider, token, priority)
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, provider, token=None, priority=INTERACTIVE):
+        """Like `acquire()`, but returns the number of seconds to wait
+        before making the call instead of waiting."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            batch = priority == BATCH
+            wait = self._quota_wait(provider, token, now, batch)
+            wait = max(wait, self._backoffs.get(provider, now) - now)
+            app_bucket = self._app_buckets.get(provider)
+            if app_bucket is None:
+                app_bucket = self._app_buckets[provider] = \
+                    TokenBucket(self.app_rate, self.app_burst)
+            app_reserve = 0
+            if batch:
+                app_reserve = app_bucket.capacity * self.batch_reserve
+            wait = max(wait, app_bucket.wait_time(now, app_reserve))
+            bucket = None
+            if token is not None:
+                key = (provider, token)
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(self.rate, self.burst)
+                    self._buckets.set(key, bucket)
+                wait = max(wait, bucket.wait_time(now))
+            if wait > self.max_wait.get(priority, 0):
+                raise RateLimitExceeded(provider, wait)
+            # Reserve the call now so concurrent callers queue behind it.
+            app_bucket.take()
+            if bucket is not None:
+                bucket.take()
+        finally:
+            self._lock.release()
+        return wait
+
+    def _quota_wait(self, provider, token, now, batch):
+        """Returns how long to wait for the quota the provider reported for
+        the token, or for the application if `token` is `None`."""
+        quota = self._quotas.get((provider, token))
+        if quota is None:
+            return 0.0
+        limit, remaining, reset = quota
+        reserve = 0
+        if batch and limit:
+            reserve = limit * self.batch_reserve
+        if remaining <= reserve and reset > now:
+            return reset - now
+        return 0.0
+
+    def update(self, provider, token, response):
+        """Records the quota reported in the headers of a response."""
+        headers = getattr(response, 'headers', None) or {}
+        key = (provider, token)
+        now = time.time()
+        remaining = headers.get(self.remaining_header)
+        if remaining is not None:
+            try:
+                limit = int(headers.get(self.limit_header) or 0)
+                reset = float(headers.get(self.reset_header) or now + 3600)
+                remaining = int(remaining)
+            except ValueError:
+                return
+            self._quotas.set(key, (limit, remaining, reset),
+                             max(1, reset - now))
+        if response.code == 429 or response.code in self.app_throttle_codes:
+            retry_after = _parse_retry_after(headers)
+            logging.warning('%s is rate limiting requests, backing off for '
+                            '%ds', provider, retry_after)
+            if response.code in self.app_throttle_codes:
+                self._backoffs.set(provider, now + retry_after, retry_after)
+            else:
+                self._quotas.set(key, (0, 0, now + retry_after), retry_after)
+
+
+def _parse_retry_after(headers, default=60):
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_retry_after(response):
+    """Returns the number of seconds after which a call refused with the
+    given response may be tried again, or `None` if it wasn't refused for
+    being rate limited, by the provider or by `RateLimitedHTTPClient`."""
+    headers = getattr(response, 'headers', None) or {}
+    if response.code in (420, 429):
+        return _parse_retry_after(headers)
+    if response.code == 503 and headers.get('Retry-After') is not None:
+        return _parse_retry_after(headers)
+    return None
+
+
+class RateLimitedHTTPClient(object):
+    """Wraps an `AsyncHTTPClient` to schedule its calls with a
+    `RateLimitScheduler`, on behalf of an access token."""
+    def __init__(self, http, scheduler, provider, token=None,
+                 priority=INTERACTIVE):
+        self.http = http
+        self.scheduler = scheduler
+        self.provider = provider
+        self.token = token
+        self.priority = priority
+
+    def fetch(self, url, callback=None, **kwargs):
+        """Like `AsyncHTTPClient.fetch()`. Calls the scheduler doesn't allow
+        aren't sent, and get a 429 response with a `Retry-After` header and
+        the `RateLimitExceeded` as its `exception` instead.
+
+        Without a callback, a call the scheduler delays is started by a
+        timer, so the returned `Future` is available at once.
+        """
+        try:
+            wait = self.scheduler.reserve(self.provider, self.token,
+                                          self.priority)
+        except RateLimitExceeded, e:
+            response = self._rate_limited(url, kwargs, e)
+            if callback is None:
+                future = httpclient.Future()
+                future.set_result(response)
+                return future
+            return callback(response)
+        if callback is not None:
+            if wait > 0:
+                time.sleep(wait)
+            return self.http.fetch(
+                url, callback=lambda response: callback(
+                    self._on_result(response)), **kwargs)
+        if wait > 0:
+            return self._fetch_later(wait, url, kwargs)
+        return self.http.fetch(url, **kwargs).map(self._on_response)
+
+    def _fetch_later(self, wait, url, kwargs):
+        started = threading.Event()
+        fetches = []
+        def waiter():
+            # Drive the fetch once the timer has started it.
+            started.wait()
+            fetches[0].wait()
+        future = httpclient.Future(waiter=waiter)
+        def on_done(fetch):
+            try:
+                future.set_result(fetch.get_result())
+            except Exception, e:
+                future.set_exception(e)
+        def start():
+            try:
+                fetch = self.http.fetch(url, **kwargs).map(self._on_response)
+            except Exception, e:
+                fetch = httpclient.Future()
+                fetch.set_exception(e)
+            fetches.append(fetch)
+            started.set()
+            fetch.add_done_callback(on_done)
+        timer = threading.Timer(wait, start)
+        timer.setDaemon(True)
+        timer.start()
+        return future
+
+    def _rate_limited(self, url, kwargs, exception):
+        request = httpclient.HTTPRequest(url, method=kwargs.get('method',
+                                                                'GET'),
+                                         headers=kwargs.get('headers'),
+                                         body=kwargs.get('body'))
+        response = httpclient.HttpResponseError(request, str(exception),
+                                                0, exception)
+        response.code = 429
+        response.headers['Retry-After'] = str(int(exception.retry_after + 1))
+        return response
+
+    def _on_response(self, future):
+        return self._on_result(future.get_result())
+
+    def _on_result(self, response):
+        self.scheduler.update(self.provider, self.token, response)
+        return response
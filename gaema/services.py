@@ -8,11 +8,14 @@ kay.ext.gaema.views
 
 """
 
+import urlparse
+
 from kay import exceptions
 from kay.ext.gaema import (
   GoogleAuth, TwitterAuth, FacebookAuth, YahooAuth
 )
 from kay.ext.gaema.auth import OpenIdMixin
+from kay.ext.gaema.httpclient import CircuitBreaker, get_circuit_state
 
 GOOG_OPENID = 'goog_openid'
 GOOG_HYBRID = 'goog_hybrid'
@@ -70,6 +73,37 @@ def get_auth_module(service_name):
 def get_service_verbose_name(service_name):
   return verbose_names[service_name]
 
+_service_hosts = {}
+
+def get_service_hosts(service_name):
+  """Returns the hosts the auth module of the service makes calls to, as
+  found in its *_URL and *_ENDPOINT attributes."""
+  hosts = _service_hosts.get(service_name)
+  if hosts is None:
+    auth_module = get_auth_module(service_name)
+    hosts = set()
+    for name in dir(auth_module):
+      if not (name.endswith('_URL') or name.endswith('_ENDPOINT')):
+        continue
+      value = getattr(auth_module, name)
+      if isinstance(value, basestring) and value.startswith('http'):
+        hosts.add(urlparse.urlparse(value).hostname)
+    _service_hosts[service_name] = hosts
+  return hosts
+
+_circuit_states = [
+  CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN
+]
+
+def get_service_state(service_name):
+  """Returns the worst circuit breaker state of the hosts of the service."""
+  states = [get_circuit_state(host)
+            for host in get_service_hosts(service_name)]
+  return max(states or [CircuitBreaker.CLOSED], key=_circuit_states.index)
+
+def is_service_available(service_name):
+  return get_service_state(service_name) != CircuitBreaker.OPEN
+
 def register_gaema_service(key, auth_module, verbose_name, use_hybrid=False):
   global available_services, auth_modules, verbose_names, hybrid_services
   if key in available_services:
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+    gaema.stores
+    ~~~~~~~~~~~~
+
+    Small key/value stores used to keep provider state, such as OpenID
+    associations, across requests.
+
+    All stores implement the same interface: `get(key, default=None)`,
+    `set(key, value, ttl=None)`, `add(key, value, ttl=None)` (which only
+    sets the value if the key is missing and returns whether it did) and
+    `delete(key)`. `ttl` is in seconds; `None` means no expiration.
+
+    :license: Apache License Version 2.0. See LICENSE.txt for more details.
+"""
+import datetime
+import pickle
+import threading
+import time
+
+try:
+    from google.appengine.api import memcache
+    from google.appengine.ext import db
+except ImportError:
+    memcache = db = None
+
+
+class _Node(object):
+    __slots__ = ('key', 'value', 'expires', 'prev', 'next')
+
+
+class MemoryStore(object):
+    """An in-process store, evicting the least recently used keys once it
+    holds more than `max_size` of them.
+
+    It is shared by all requests served by the process, but not across
+    processes or App Engine instances.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._nodes = {}
+        # Sentinel of a circular doubly-linked list, most recent first.
+        self._head = _Node()
+        self._head.prev = self._head.next = self._head
+        self._lock = threading.Lock()
+
+    def _unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def _push_front(self, node):
+        node.prev = self._head
+        node.next = self._head.next
+        self._head.next.prev = node
+        self._head.next = node
+
+    def _lookup(self, key):
+        node = self._nodes.get(key)
+        if node is None:
+            return None
+        if node.expires is not None and node.expires <= time.time():
+            self._unlink(node)
+            del self._nodes[key]
+            return None
+        self._unlink(node)
+        self._push_front(node)
+        return node
+
+    def _store(self, key, value, ttl):
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._nodes[key] = _Node()
+            node.key = key
+        else:
+            self._unlink(node)
+        node.value = value
+        node.expires = None
+        if ttl is not None:
+            node.expires = time.time() + ttl
+        self._push_front(node)
+        while len(self._nodes) > self.max_size:
+            oldest = self._head.prev
+            self._unlink(oldest)
+            del self._nodes[oldest.key]
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            node = self._lookup(key)
+            if node is None:
+                return default
+            return node.value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        self._lock.acquire()
+        try:
+            self._store(key, value, ttl)
+        finally:
+            self._lock.release()
+
+    def add(self, key, value, ttl=None):
+        self._lock.acquire()
+        try:
+            if self._lookup(key) is not None:
+                return False
+            self._store(key, value, ttl)
+            return True
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            node = self._nodes.pop(key, None)
+            if node is not None:
+                self._unlink(node)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._nodes.clear()
+            self._head.prev = self._head.next = self._head
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+# memcache reads expiration times longer than this as Unix timestamps.
+_MEMCACHE_MAX_RELATIVE_TIME = 86400 * 30
+
+
+def _memcache_time(ttl):
+    if not ttl:
+        return 0
+    if ttl > _MEMCACHE_MAX_RELATIVE_TIME:
+        return int(time.time() + ttl)
+    return ttl
+
+
+class MemcacheStore(object):
+    """A store backed by App Engine's memcache."""
+    def __init__(self, namespace='gaema'):
+        self.namespace = namespace
+
+    def get(self, key, default=None):
+        value = memcache.get(key, namespace=self.namespace)
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        memcache.set(key, value, time=_memcache_time(ttl),
+                     namespace=self.namespace)
+
+    def add(self, key, value, ttl=None):
+        return memcache.add(key, value, time=_memcache_time(ttl),
+                            namespace=self.namespace)
+
+    def delete(self, key):
+        memcache.delete(key, namespace=self.namespace)
+
+
+if db is not None:
+    class GaemaStoreEntry(db.Model):
+        """A value kept by `DatastoreStore`, keyed by its store key."""
+        value = db.BlobProperty()
+        expires = db.DateTimeProperty()
+
+
+class DatastoreStore(object):
+    """A store backed by the App Engine datastore.
+
+    Expired entries are ignored but not deleted; clean them up with a cron
+    job querying `GaemaStoreEntry.expires` if needed.
+    """
+    def __init__(self, model=None):
+        if model is None:
+            model = GaemaStoreEntry
+        self.model = model
+
+    def _entry(self, key):
+        entry = self.model.get_by_key_name(key)
+        if entry is None:
+            return None
+        if entry.expires is not None and \
+           entry.expires <= datetime.datetime.utcnow():
+            return None
+        return entry
+
+    def _new_entry(self, key, value, ttl):
+        expires = None
+        if ttl is not None:
+            expires = datetime.datetime.utcnow() + \
+                datetime.timedelta(seconds=ttl)
+        return self.model(key_name=key, expires=expires,
+                          value=pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def get(self, key, default=None):
+        entry = self._entry(key)
+        if entry is None:
+            return default
+        return pickle.loads(entry.value)
+
+    def set(self, key, value, ttl=None):
+        self._new_entry(key, value, ttl).put()
+
+    def add(self, key, value, ttl=None):
+        def txn():
+            if self._entry(key) is not None:
+                return False
+            self._new_entry(key, value, ttl).put()
+            return True
+        return db.run_in_transaction(txn)
+
+    def delete(self, key):
+        db.delete(db.Key.from_path(self.model.kind(), key))
+
+
+class AccessTokenStore(object):
+    """Keeps provider access tokens and their expiration time per
+    `(service, user_id)`, on top of any of the stores above.
+
+    :param store:
+        The backing store; defaults to a `MemoryStore`.
+    :param refresh_margin:
+        Tokens expiring within this many seconds are flagged as
+        `expiring`, so callers can renew them before they fail.
+    """
+    def __init__(self, store=None, refresh_margin=3600):
+        if store is None:
+            store = MemoryStore()
+        self.store = store
+        self.refresh_margin = refresh_margin
+
+    def _key(self, service, user_id):
+        return 'access_token:%s:%s' % (service, user_id)
+
+    def set(self, service, user_id, access_token, expires=None):
+        """Stores a token. `expires` is a Unix timestamp, or `None` for
+        tokens that don't expire."""
+        ttl = None
+        if expires is not None:
+            ttl = int(expires - time.time())
+            if ttl <= 0:
+                return
+        self.store.set(self._key(service, user_id),
+                       (access_token, expires), ttl)
+
+    def get(self, service, user_id):
+        """Returns a dict with the `access_token`, its `expires` time and
+        whether it is `expiring`, or `None` if no valid token is stored."""
+        entry = self.store.get(self._key(service, user_id))
+        if entry is None:
+            return None
+        access_token, expires = entry
+        if expires is not None and expires <= time.time():
+            return None
+        return {
+            'access_token': access_token,
+            'expires': expires,
+            'expiring': expires is not None and
+                        expires - time.time() < self.refresh_margin,
+        }
+
+    def get_access_token(self, service, user_id):
+        """Returns just the access token, or `None`."""
+        entry = self.get(service, user_id)
+        if entry is None:
+            return None
+        return entry['access_token']
+
+    def delete(self, service, user_id):
+        self.store.delete(self._key(service, user_id))
@@ -8,6 +8,12 @@ kay.ext.gaema.utils
 :license: BSD, see LICENSE for more details.
 """
 
+import base64
+import hashlib
+import hmac
+import logging
+
+import simplejson
 from werkzeug.contrib.securecookie import SecureCookie
 from werkzeug.exceptions import InternalServerError
 
@@ -19,6 +25,7 @@ from kay.ext.gaema import (
   NEXT_URL_KEY_FORMAT, GAEMA_USER_KEY_FORMAT
 )
 
+from kay.ext.gaema import escape
 from kay.ext.gaema import services
 
 def get_valid_services():
@@ -44,29 +51,129 @@ def create_marketplace_logout_url(domain, nexturl="/"):
   set_cookie(next_url_key, nexturl)
   return url_for("gaema/marketplace_logout", domain=domain)
 
-def get_gaema_user(service):
+# User fields kept in gaema cookies unless GAEMA_COOKIE_FIELDS says
+# otherwise: what identifies the user, plus the credentials needed to call
+# the provider APIs on their behalf.
+DEFAULT_COOKIE_FIELDS = (
+  '_service', 'claimed_id', 'id', 'uid', 'facebook_uid', 'name',
+  'first_name', 'last_name', 'username', 'screen_name', 'email', 'locale',
+  'access_token', 'session_key', 'session_expires',
+)
+
+COOKIE_VERSION = '2'
+# Small cookies are left uncompressed.
+COOKIE_COMPRESS_MIN_SIZE = 200
+_MAX_COOKIE_SIZE = 4000
+
+_cookie_keys = {}
+
+def _cookie_key():
+  secret_key = settings.SECRET_KEY
+  key = _cookie_keys.get(secret_key)
+  if key is None:
+    # Derive a key of its own rather than signing with SECRET_KEY itself.
+    key = _cookie_keys[secret_key] = hmac.new(
+      secret_key, 'kay.ext.gaema.cookie', hashlib.sha256).digest()
+  return key
+
+def _cookie_signature(value):
+  return base64.urlsafe_b64encode(
+    hmac.new(_cookie_key(), value, hashlib.sha256).digest()).rstrip('=')
+
+def _b64decode(value):
+  return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def encode_gaema_cookie(user):
+  """Serializes a gaema user into a signed cookie value.
+
+  Only the fields listed in GAEMA_COOKIE_FIELDS are kept. The value is
+  `<version><flag>.<payload>.<signature>`: the payload is compact JSON,
+  zlib compressed if that makes it smaller (flag `z`, `j` otherwise), and
+  the signature an HMAC-SHA256 of everything before it.
+  """
+  if user is None:
+    return ''
+  fields = getattr(settings, 'GAEMA_COOKIE_FIELDS', DEFAULT_COOKIE_FIELDS)
+  compressed, data = escape.compress(escape.json_encode_compact(
+    dict((k, v) for k, v in user.iteritems() if k in fields)),
+    COOKIE_COMPRESS_MIN_SIZE)
+  value = '%s%s.%s' % (COOKIE_VERSION, compressed and 'z' or 'j',
+                       base64.urlsafe_b64encode(data).rstrip('='))
+  value = '%s.%s' % (value, _cookie_signature(value))
+  if len(value) > _MAX_COOKIE_SIZE:
+    logging.warning('gaema cookie for %s is %d bytes long, browsers may '
+                    'drop it', user.get('_service'), len(value))
+  return value
+
+def decode_gaema_cookie(value):
+  """Returns the gaema user stored in a cookie value, or None if it isn't
+  validly signed. Cookies written by SecureCookie, which always contain a
+  `?`, are still accepted."""
+  if not value:
+    return None
+  if '?' in value:
+    return SecureCookie.unserialize(value, secret_key=settings.SECRET_KEY)
+  try:
+    signed, signature = value.rsplit('.', 1)
+    header, payload = signed.split('.', 1)
+  except ValueError:
+    return None
+  if header[:1] != COOKIE_VERSION or \
+     not escape.time_independent_equals(_cookie_signature(signed),
+                                        signature):
+    return None
+  return simplejson.loads(escape.decompress(_b64decode(payload),
+                                            header[1:] == 'z'))
+
+_GAEMA_USERS_ATTR = '_gaema_users'
+
+def _get_request_users():
+  """Returns the gaema users decoded so far in the current request, keyed
+  by service."""
+  users = getattr(local.request, _GAEMA_USERS_ATTR, None)
+  if users is None:
+    users = {}
+    setattr(local.request, _GAEMA_USERS_ATTR, users)
+  return users
+
+def _load_gaema_user(service, use_cookie):
+  gaema_user_key = GAEMA_USER_KEY_FORMAT % service
+  if use_cookie:
+    user_data = local.request.cookies.get(gaema_user_key, None) or ''
+    if isinstance(user_data, unicode):
+      # Valid values are ASCII; others fail the signature check.
+      user_data = user_data.encode('utf-8', 'replace')
+    return decode_gaema_cookie(user_data)
+  return local.request.session.get(gaema_user_key, None)
+
+def _use_cookie():
+  return getattr(settings, "GAEMA_STORAGE", None) == "cookie"
+
+def get_gaema_users(services):
+  """Returns a dict mapping each of the given services to its gaema user,
+  or None. Each user is decoded at most once per request."""
   try:
-    gaema_user_key = GAEMA_USER_KEY_FORMAT % service
-    if hasattr(settings, "GAEMA_STORAGE") and \
-          settings.GAEMA_STORAGE == "cookie":
-      user_data = local.request.cookies.get(gaema_user_key, None)
-      if user_data:
-        return SecureCookie.unserialize(user_data,
-                                        secret_key=settings.SECRET_KEY)
-    else:
-      return local.request.session.get(gaema_user_key, None)
+    users = _get_request_users()
+    use_cookie = _use_cookie()
+    for service in services:
+      if service not in users:
+        users[service] = _load_gaema_user(service, use_cookie)
+    return dict((service, users[service]) for service in services)
   except Exception, e:
     raise InternalServerError('Getting gaema_user failed, reason: %s' % e)
 
+def get_gaema_user(service):
+  return get_gaema_users([service])[service]
+
 def set_gaema_user(service, user):
   gaema_user_key = GAEMA_USER_KEY_FORMAT % service
-  if hasattr(settings, "GAEMA_STORAGE") and settings.GAEMA_STORAGE == "cookie":
-    secure_cookie = SecureCookie(user, secret_key=settings.SECRET_KEY)
-    user_data = secure_cookie.serialize()
-    set_cookie(gaema_user_key, user_data)
+  if _use_cookie():
+    set_cookie(gaema_user_key, encode_gaema_cookie(user))
   else:
     from kay.sessions import renew_session
     renew_session(local.request)
     local.request.session[gaema_user_key] = user
     local.request.session.modified = True
-  
+  # The request still carries the old value; later lookups in this request
+  # should see the new one.
+  _get_request_users()[service] = user
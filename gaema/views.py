@@ -22,13 +22,21 @@ from kay.ext.gaema.utils import (
 )
 from kay.ext.gaema.services import (
   get_service_verbose_name, get_auth_module, use_hybrid,
+  get_service_state, is_service_available,
   GOOG_OPENID, GOOG_HYBRID, TWITTER, FACEBOOK, YAHOO
 )
+from kay.ext.gaema.httpclient import CircuitBreaker
 
 # Create your views here.
 
 def select_service(request, targets):
   targets = targets.split('|')
+  # Hide the services whose provider is down, unless all of them are, and
+  # list the ones recovering from an outage last.
+  targets = [target for target in targets
+             if is_service_available(target)] or targets
+  targets.sort(key=lambda target:
+               get_service_state(target) != CircuitBreaker.CLOSED)
   next_url = unquote_plus(request.args.get('next_url'))
   urls = []
   for target in targets: